@@ -16,21 +16,134 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 __author__ = 'Fenix'
-__version__ = '1.5.1'
+__version__ = '1.6'
 
 import b3
 import b3.plugin
 import b3.events
+import copy
 import os
 import re
 
 from b3.functions import getCmd
+from b3.functions import minutesStr
+from collections import deque
+from itertools import count
 from ConfigParser import NoOptionError
 from ConfigParser import NoSectionError
+from allowlist import Allowlist
+from allowlist import normalize_entry
+from cache import VerdictCache
+from feeds import FeedManager
+from iputils import format_network
+from iputils import ip2long
+from iputils import long2bytes
+from iputils import parse_network
+from iputils import prefix_network
+from iputils import split_families
+from proxyscanner import BloomFilterProxyScanner
+from proxyscanner import LocalFeedProxyScanner
 from proxyscanner import WinmxunlimitedProxyScanner
 from proxyscanner import GeolocationPluginProxyScanner
+from proxyscanner import compile_location_rules
+from threading import Event
+from threading import Lock
 from threading import Thread
 from time import time
+from tracing import Tracer
+from Queue import Empty
+from Queue import PriorityQueue
+
+
+class ScanVerdict(object):
+    """
+    Hold the outcome of an authoritative proxy scan so that shadow scanners can compare against it.
+    """
+    def __init__(self):
+        """
+        Object constructor.
+        """
+        self.detected = None
+        self.service = None
+        self._done = Event()
+
+    def set(self, detected, service=None):
+        """
+        Store the authoritative verdict and wake up whoever is waiting for it.
+        """
+        self.detected = detected
+        self.service = service
+        self._done.set()
+
+    def wait(self, timeout):
+        """
+        Wait (at most timeout seconds) for the authoritative verdict.
+        Will return the verdict or None if it was not produced in time.
+        """
+        self._done.wait(timeout)
+        return self.detected
+
+
+class ScanJob(object):
+    """
+    A queued or in-flight proxy scan: holds just what is needed to scan the client and find it again
+    afterwards, so that scans don't keep client objects alive after the player left.
+    """
+    __slots__ = ('cid', 'id', 'ip', 'name', 'location', 'token', 'time_add', 'verdict', 'trace', 'remote')
+
+    def __init__(self, client, token, verdict=None, trace=None, remote=True):
+        """
+        Object constructor.
+        :param client: The client to be scanned
+        :param token: The token of the client session the scan belongs to
+        :param verdict: The ScanVerdict shadow scanners compare against (if any)
+        :param trace: The Trace recording the scan timeline (if sampled)
+        :param remote: Whether to use proxy scanners contacting remote services
+        """
+        self.cid = client.cid
+        self.id = client.id
+        self.ip = client.ip
+        self.name = client.name
+        self.location = getattr(client, 'location', None)
+        self.token = token
+        self.time_add = time()
+        self.verdict = verdict
+        self.trace = trace
+        self.remote = remote
+
+
+# proxy scan states of a client session
+STATE_PENDING = 'pending'    # scan requested, waiting in the queue (or held)
+STATE_SCANNING = 'scanning'  # scan in progress
+STATE_CLEAN = 'clean'        # no proxy detected
+STATE_FLAGGED = 'flagged'    # proxy detected
+
+
+class ScanSession(object):
+    """
+    The proxy scan state of a connected client: one scan per client id and ip address.
+    """
+    __slots__ = ('id', 'ip', 'token', 'state')
+
+    def __init__(self, id, ip, token):
+        """
+        Object constructor.
+        """
+        self.id = id
+        self.ip = ip
+        self.token = token
+        self.state = None
+
+
+# scan queue priorities: local-only scans are fast, they don't wait behind the remote lookups
+PRIORITY_STOP = 0
+PRIORITY_LOCAL = 1
+PRIORITY_REMOTE = 2
+
+# load modes of the scan pipeline
+MODE_NORMAL = 'normal'  # every proxy scanner is used
+MODE_LOCAL = 'local'    # remote proxy scanners are skipped
+MODE_CACHE = 'cache'    # only cached verdicts are enforced
 
 
 class ProxyfilterPlugin(b3.plugin.Plugin):
@@ -43,27 +156,97 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
         'maxlevel': 40,
         'reason': '^1proxy detected',
         'timeout': 4,
+        'shadowtimeout': 8,
+        'cachettl': 3600,
+        'cachesize': 10000,
+        'cachefile': None,
+        'prefixthreshold': 3,
+        'prefixttl': 86400,
+        'lookuplimit': 5,
+        'workers': 4,
+        'queuehigh': 20,
+        'queuecritical': 100,
+        'latencyhigh': 3.0,
+        'holdpending': True,
+        'trustscans': 50,
+        'truststable': 20,
+        'trustage': 30,
         'services': {
             'winmxunlimited': {
                 'enabled': True,
+                'shadow': False,
                 'class': WinmxunlimitedProxyScanner,
                 'url': 'http://winmxunlimited.net/api/proxydetection/v1/query/?ip=%s'
             },
             'geolocationplugin': {
                 'enabled': True,
+                'shadow': False,
                 'class': GeolocationPluginProxyScanner,
                 'url': None
+            },
+            'bloomfilter': {
+                'enabled': False,
+                'shadow': False,
+                'class': BloomFilterProxyScanner,
+                'url': None
+            },
+            'localfeed': {
+                'enabled': False,
+                'shadow': False,
+                'class': LocalFeedProxyScanner,
+                'url': None
             }
+        },
+        'bloomfilter': {
+            'feed': None,
+            'filter': None
+        },
+        'feeds': {
+            'directory': None,
+            'interval': 60
+        },
+        'geolocation': {
+            'rules': {'country': ['proxy']},
+            'compiled': []
+        },
+        'tracing': {
+            'file': None,
+            'samplerate': 1.0,
+            'maxbytes': 10485760,
+            'backups': 5,
+            'profile': False
         }
     }
 
     sql = {
-        'q1': """INSERT INTO proxies (client_id, service, ip, time_add) VALUES ('%s', '%s', '%s', '%d')""",
+        'q1': """INSERT INTO proxies (client_id, service, ip, ip_bin, time_add) VALUES ('%s', '%s', '%s', %s, '%d')""",
         'q2': """SELECT COUNT(DISTINCT ip) AS total FROM proxies""",
         'q3': """SELECT service, COUNT(*) AS total FROM proxies GROUP BY service ORDER BY service ASC""",
+        'q4': """SELECT COUNT(DISTINCT ip_bin) AS total FROM proxies WHERE ip_bin BETWEEN %s AND %s""",
+        'q5': """SELECT MIN(ip) AS ip, COUNT(*) AS total FROM proxies WHERE ip_bin BETWEEN %s AND %s
+                  GROUP BY SUBSTR(ip_bin, 1, %d) ORDER BY total DESC LIMIT %d""",
+        'q6': """SELECT ip_bin FROM proxies LIMIT 1""",
+        'q7': """SELECT id, ip FROM proxies WHERE ip_bin IS NULL AND id > %d ORDER BY id ASC LIMIT %d""",
+        'q8': """UPDATE proxies SET ip_bin = %s WHERE id = %d""",
+        'q9': """SELECT id, client_id, service, ip, time_add FROM proxies
+                  WHERE ip_bin BETWEEN %s AND %s AND (ip_bin > %s OR (ip_bin = %s AND id > %d))
+                  ORDER BY ip_bin ASC, id ASC LIMIT %d""",
+        'q10': """SELECT id, client_id, service, ip, time_add FROM proxies
+                   WHERE client_id = %d AND id > %d ORDER BY id ASC LIMIT %d""",
+        'q11': """SELECT client_id, ip_prefix, clean_streak, stable_streak, last_flag FROM proxies_reputation
+                   WHERE client_id = %d""",
+        'q12': """INSERT INTO proxies_reputation (client_id, ip_prefix, clean_streak, stable_streak, last_flag, time_edit)
+                   VALUES (%d, '%s', %d, %d, %d, %d)""",
+        'q13': """UPDATE proxies_reputation SET ip_prefix = '%s', clean_streak = %d, stable_streak = %d, last_flag = %d,
+                   time_edit = %d WHERE client_id = %d""",
+        'q14': """SELECT entry FROM proxies_allowlist""",
+        'q15': """INSERT INTO proxies_allowlist (entry, admin_id, time_add) VALUES ('%s', %d, %d)""",
+        'q16': """DELETE FROM proxies_allowlist WHERE entry = '%s'""",
     }
 
-    services = {}
+    feeds = None
+    cache = None
+    tracer = None
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -79,6 +262,9 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
         """
         b3.plugin.Plugin.__init__(self, console, config)
 
+        # the class level settings are the defaults: every instance loads its configuration in its own copy
+        self.settings = copy.deepcopy(ProxyfilterPlugin.settings)
+
         self.adminPlugin = self.console.getPlugin('admin')
         if not self.adminPlugin:
             raise AttributeError('could not start without admin plugin')
@@ -88,9 +274,51 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
             'proxy_list': '''^7Proxy services: $services''',
             'stats_no_proxies': '''^7No proxy have been detected till now''',
             'stats_count_proxies': '''^^7[^4$count^7] ^7proxy detected till now''',
-            'stats_detail_pattern': '''^7[^4$count^7] ^7: ^3$service'''
+            'stats_detail_pattern': '''^7[^4$count^7] ^7: ^3$service''',
+            'stats_network_proxies': '''^7[^4$count^7] ^7proxy detected in ^3$network''',
+            'stats_prefix_pattern': '''^7[^4$count^7] ^7: ^3$prefix''',
+            'shadow_no_services': '''^7No proxy service is running in shadow mode''',
+            'shadow_stats_pattern': '''^3$service^7: ^4$scans ^7scans, ^4$positives ^7positives, '''
+                                    '''^1$disagreements ^7disagreements, ^4$latency^7ms avg''',
+            'lookup_cached': '''^7Cached verdict for ^3$ip^7: $verdict''',
+            'lookup_cached_network': '''^7[^4$count^7] ^7cached proxy verdicts in ^3$network''',
+            'lookup_pattern': '''^7#^4$id ^3$ip ^7@^4$client ^7[^3$service^7] ^7$time''',
+            'lookup_no_results': '''^7No proxy detection found for ^3$target''',
+            'lookup_more': '''^7More results available, type ^3!^7proxylookup next''',
+            'metrics_empty': '''^7No metric has been collected till now''',
+            'metrics_pattern': '''^3$name^7: ^4$value''',
+            'prefixes_empty': '''^7No network has been flagged till now''',
+            'prefixes_pattern': '''^3$network^7: ^4$count ^7proxies [^3$service^7], expires in ^4$expire''',
+            'allow_empty': '''^7The proxy allowlist is empty''',
+            'allow_list': '''^7Proxy allowlist: ^3$entries'''
         }
 
+        # proxy scanner registries: these dicts are never modified once published (copy on write)
+        # so scan threads can iterate over them without locking while admins toggle services
+        self.services = {}
+        self.shadows = {}
+        self._registry_lock = Lock()
+
+        self.shadow_stats = {}
+        self._shadow_lock = Lock()
+        self.metrics = {}
+        self._metrics_lock = Lock()
+        self._lookups = {}
+        self.allowlist = Allowlist()
+
+        # scan pipeline: (priority, sequence, job) tuples, None jobs stop the workers
+        self.queue = PriorityQueue()
+        self._sequence = count()
+        self.load_mode = MODE_NORMAL
+        self._load_lock = Lock()
+        self._latencies = deque()
+        self._pending = {}
+        self._workers = []
+        self._sessions = {}
+        self._session_lock = Lock()
+        self._tokens = count(1)
+        self._traces = {}
+
     def onLoadConfig(self):
         """
         Load plugin configuration.
@@ -119,14 +347,178 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
             self.error('could not load settings/timeout config value: %s' % e)
             self.debug('using default value (%s) for settings/timeout' % self.settings['timeout'])
 
+        try:
+            self.settings['shadowtimeout'] = self.config.getint('settings', 'shadowtimeout')
+            self.debug('loaded settings/shadowtimeout: %s' % self.settings['shadowtimeout'])
+        except NoOptionError:
+            self.warning('could not find settings/shadowtimeout in config file, '
+                         'using default: %s' % self.settings['shadowtimeout'])
+        except ValueError, e:
+            self.error('could not load settings/shadowtimeout config value: %s' % e)
+            self.debug('using default value (%s) for settings/shadowtimeout' % self.settings['shadowtimeout'])
+
+        try:
+            self.settings['cachefile'] = self.config.getpath('settings', 'cachefile')
+            self.debug('loaded settings/cachefile: %s' % self.settings['cachefile'])
+        except NoOptionError:
+            self.debug('could not find settings/cachefile in config file: cached verdicts will not be persisted')
+
+        for option in ('cachettl', 'cachesize', 'prefixthreshold', 'prefixttl', 'lookuplimit'):
+            try:
+                value = self.config.getint('settings', option)
+                if value < 0:
+                    raise ValueError('%s must be a positive number' % option)
+                self.settings[option] = value
+                self.debug('loaded settings/%s: %s' % (option, self.settings[option]))
+            except NoOptionError:
+                self.warning('could not find settings/%s in config file, using default: %s' % (option, self.settings[option]))
+            except ValueError, e:
+                self.error('could not load settings/%s config value: %s' % (option, e))
+                self.debug('using default value (%s) for settings/%s' % (self.settings[option], option))
+
+        for option in ('workers', 'queuehigh', 'queuecritical', 'trustscans', 'truststable', 'trustage'):
+            try:
+                value = self.config.getint('settings', option)
+                if value < 0 or (option == 'workers' and value == 0):
+                    raise ValueError('%s must be a positive number' % option)
+                self.settings[option] = value
+                self.debug('loaded settings/%s: %s' % (option, self.settings[option]))
+            except NoOptionError:
+                self.warning('could not find settings/%s in config file, using default: %s' % (option, self.settings[option]))
+            except ValueError, e:
+                self.error('could not load settings/%s config value: %s' % (option, e))
+                self.debug('using default value (%s) for settings/%s' % (self.settings[option], option))
+
+        try:
+            self.settings['latencyhigh'] = self.config.getfloat('settings', 'latencyhigh')
+            self.debug('loaded settings/latencyhigh: %s' % self.settings['latencyhigh'])
+        except NoOptionError:
+            self.warning('could not find settings/latencyhigh in config file, '
+                         'using default: %s' % self.settings['latencyhigh'])
+        except ValueError, e:
+            self.error('could not load settings/latencyhigh config value: %s' % e)
+            self.debug('using default value (%s) for settings/latencyhigh' % self.settings['latencyhigh'])
+
+        try:
+            self.settings['holdpending'] = self.config.getboolean('settings', 'holdpending')
+            self.debug('loaded settings/holdpending: %s' % self.settings['holdpending'])
+        except NoOptionError:
+            self.warning('could not find settings/holdpending in config file, '
+                         'using default: %s' % self.settings['holdpending'])
+        except ValueError, e:
+            self.error('could not load settings/holdpending config value: %s' % e)
+            self.debug('using default value (%s) for settings/holdpending' % self.settings['holdpending'])
+
+        try:
+            self.settings['bloomfilter']['feed'] = self.config.getpath('bloomfilter', 'feed')
+            self.debug('loaded bloomfilter/feed: %s' % self.settings['bloomfilter']['feed'])
+        except (NoSectionError, NoOptionError):
+            self.debug('could not find bloomfilter/feed in config file: bloomfilter service will not be available')
+
+        try:
+            self.settings['bloomfilter']['filter'] = self.config.getpath('bloomfilter', 'filter')
+            self.debug('loaded bloomfilter/filter: %s' % self.settings['bloomfilter']['filter'])
+        except (NoSectionError, NoOptionError):
+            self.debug('could not find bloomfilter/filter in config file: the filter is expected next to the feed')
+
+        try:
+            self.settings['feeds']['directory'] = self.config.getpath('feeds', 'directory')
+            self.debug('loaded feeds/directory: %s' % self.settings['feeds']['directory'])
+        except (NoSectionError, NoOptionError):
+            self.debug('could not find feeds/directory in config file: localfeed service will not be available')
+
+        try:
+            self.settings['feeds']['interval'] = self.config.getint('feeds', 'interval')
+            self.debug('loaded feeds/interval: %s' % self.settings['feeds']['interval'])
+        except (NoSectionError, NoOptionError):
+            self.debug('could not find feeds/interval in config file, '
+                       'using default: %s' % self.settings['feeds']['interval'])
+        except ValueError, e:
+            self.error('could not load feeds/interval config value: %s' % e)
+            self.debug('using default value (%s) for feeds/interval' % self.settings['feeds']['interval'])
+
+        try:
+            rules = {}
+            for field in self.config.options('geolocation'):
+                rules[field] = []
+                for line in self.config.get('geolocation', field).splitlines():
+                    line = line.strip()
+                    # regular expressions take the whole line since they may contain commas
+                    if line.startswith('re:'):
+                        rules[field].append(line)
+                    else:
+                        rules[field].extend(x.strip() for x in line.split(',') if x.strip())
+                self.debug('loaded geolocation/%s: %s rules' % (field, len(rules[field])))
+            self.settings['geolocation']['rules'] = rules
+        except NoSectionError:
+            self.debug('could not find section "geolocation" in config file, '
+                       'using default rules: %s' % self.settings['geolocation']['rules'])
+
+        try:
+            self.settings['geolocation']['compiled'] = compile_location_rules(self.settings['geolocation']['rules'])
+        except ValueError, e:
+            self.error('could not compile geolocation rules: %s' % e)
+            self.debug('using default geolocation rules: country: proxy')
+            self.settings['geolocation']['compiled'] = compile_location_rules({'country': ['proxy']})
+
+        try:
+            self.settings['tracing']['file'] = self.config.getpath('tracing', 'file')
+            self.debug('loaded tracing/file: %s' % self.settings['tracing']['file'])
+        except (NoSectionError, NoOptionError):
+            self.debug('could not find tracing/file in config file: proxy scans will not be traced')
+
+        try:
+            samplerate = self.config.getfloat('tracing', 'samplerate')
+            if not 0 < samplerate <= 1:
+                raise ValueError('samplerate must be between 0 and 1')
+            self.settings['tracing']['samplerate'] = samplerate
+            self.debug('loaded tracing/samplerate: %s' % self.settings['tracing']['samplerate'])
+        except (NoSectionError, NoOptionError):
+            self.debug('could not find tracing/samplerate in config file, '
+                       'using default: %s' % self.settings['tracing']['samplerate'])
+        except ValueError, e:
+            self.error('could not load tracing/samplerate config value: %s' % e)
+            self.debug('using default value (%s) for tracing/samplerate' % self.settings['tracing']['samplerate'])
+
+        for option in ('maxbytes', 'backups'):
+            try:
+                value = self.config.getint('tracing', option)
+                if value < 0:
+                    raise ValueError('%s must be a positive number' % option)
+                self.settings['tracing'][option] = value
+                self.debug('loaded tracing/%s: %s' % (option, self.settings['tracing'][option]))
+            except (NoSectionError, NoOptionError):
+                self.debug('could not find tracing/%s in config file, '
+                           'using default: %s' % (option, self.settings['tracing'][option]))
+            except ValueError, e:
+                self.error('could not load tracing/%s config value: %s' % (option, e))
+                self.debug('using default value (%s) for tracing/%s' % (self.settings['tracing'][option], option))
+
+        try:
+            self.settings['tracing']['profile'] = self.config.getboolean('tracing', 'profile')
+            self.debug('loaded tracing/profile: %s' % self.settings['tracing']['profile'])
+        except (NoSectionError, NoOptionError):
+            self.debug('could not find tracing/profile in config file, '
+                       'using default: %s' % self.settings['tracing']['profile'])
+        except ValueError, e:
+            self.error('could not load tracing/profile config value: %s' % e)
+            self.debug('using default value (%s) for tracing/profile' % self.settings['tracing']['profile'])
+
         try:
             for s in self.config.options('services'):
                 if s not in self.settings['services']:
                     self.warning('invalid proxy scanner service found in configuration file: %s' % s)
                 else:
                     try:
-                        self.settings['services'][s]['enabled'] = self.config.getboolean('services', s)
-                        self.debug('using proxy scanner [%s] : %s' % (s, self.settings['services'][s]['enabled']))
+                        if self.config.get('services', s).strip().lower() == 'shadow':
+                            # run the scanner without letting it influence the enforcement decision
+                            self.settings['services'][s]['enabled'] = True
+                            self.settings['services'][s]['shadow'] = True
+                        else:
+                            self.settings['services'][s]['enabled'] = self.config.getboolean('services', s)
+                            self.settings['services'][s]['shadow'] = False
+                        self.debug('using proxy scanner [%s] : %s%s' % (s, self.settings['services'][s]['enabled'],
+                                   ' (shadow)' if self.settings['services'][s]['shadow'] else ''))
                     except ValueError, e:
                         self.error('could not load services/%s configuration value: %s' % (s, e))
                         self.debug('using proxy scanner [%s] : %s' % (s, self.settings['services'][s]['enabled']))
@@ -140,9 +532,11 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
         """
         # create database tables (if needed)
         if 'proxies' not in self.console.storage.getTables():
-            external_dir = self.console.config.get_external_plugins_dir()
-            sql_path = os.path.join(external_dir, 'proxyfilter', 'sql', self.console.storage.dsnDict['protocol'], 'proxyfilter.sql')
-            self.console.storage.queryFromFile(sql_path)
+            self.console.storage.queryFromFile(self.get_sql_path('proxyfilter.sql'))
+        else:
+            self.upgrade_tables()
+
+        self.load_allowlist()
 
         # register our commands
         if 'commands' in self.config.sections():
@@ -157,60 +551,561 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
                 if func:
                     self.adminPlugin.registerCommand(self, cmd, level, func, alias)
 
+        # create the verdict cache (a zero ttl disables it)
+        if self.settings['cachettl'] and self.settings['cachesize']:
+            self.cache = VerdictCache(self.settings['cachettl'], self.settings['cachesize'],
+                                      self.settings['prefixthreshold'], self.settings['prefixttl'])
+            if self.settings['cachefile'] and os.path.isfile(self.settings['cachefile']):
+                try:
+                    loaded = self.cache.load(self.settings['cachefile'])
+                    self.debug('loaded %s cached verdicts from %s' % (loaded, self.settings['cachefile']))
+                except IOError, e:
+                    self.error('could not load cached verdicts from %s: %s' % (self.settings['cachefile'], e))
+
+        # open the trace file (tracing is disabled if no file is configured)
+        if self.settings['tracing']['file']:
+            try:
+                self.tracer = Tracer(self.settings['tracing']['file'], self.settings['tracing']['samplerate'],
+                                     self.settings['tracing']['maxbytes'], self.settings['tracing']['backups'],
+                                     self.settings['tracing']['profile'])
+            except (IOError, OSError), e:
+                self.error('could not open trace file %s: %s' % (self.settings['tracing']['file'], e))
+
+        # local feeds are watched by the localfeed service only while it's running
+        if self.settings['feeds']['directory']:
+            self.feeds = FeedManager(self, self.settings['feeds']['directory'], self.settings['feeds']['interval'])
+
         # create proxy scanner instances
         for keyword in self.settings['services']:
             if self.settings['services'][keyword]['enabled']:
                 self.init_proxy_service(keyword)
 
+        self.start_workers()
+
         self.registerEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', self.doProxyScan)
         self.registerEvent('EVT_CLIENT_GEOLOCATION_FAILURE', self.doProxyScan)
         self.registerEvent('EVT_CLIENT_AUTH', self.onAuth)
+        self.registerEvent('EVT_CLIENT_DISCONNECT', self.onDisconnect)
         self.registerEvent('EVT_PLUGIN_DISABLED', self.onPluginDisabled)
         self.registerEvent('EVT_PLUGIN_ENABLED', self.onPluginEnabled)
+        self.registerEvent('EVT_STOP', self.onStop)
 
         # notice plugin started
         self.debug('plugin started')
 
+    def onEnable(self):
+        """
+        Executed when the plugin is enabled.
+        """
+        if self.feeds and ('localfeed' in self.services or 'localfeed' in self.shadows):
+            self.feeds.start()
+        self.start_workers()
+
+    def onDisable(self):
+        """
+        Executed when the plugin is disabled.
+        """
+        self.stop_workers()
+        if self.feeds:
+            self.feeds.stop()
+        if self.tracer:
+            self.tracer.dump()
+        self.save_cache()
+
     ####################################################################################################################
     #                                                                                                                  #
     #   EVENTS                                                                                                         #
     #                                                                                                                  #
     ####################################################################################################################
 
-    def _threaded_proxy_scan(self, client):
+    def start_workers(self):
         """
-        Perform proxy server detection on the given client.
-        Will be executed in a separate thread so B3 won't hang on checking.
+        Start the scan workers (if not running already).
+        """
+        if self._workers:
+            return
+        for i in xrange(self.settings['workers']):
+            worker = Thread(target=self._threaded_scan_worker, name='proxyfilter-worker-%s' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self._workers.append(worker)
+
+    def stop_workers(self, timeout=10):
+        """
+        Stop the scan workers: queued and held scans are discarded (their clients are scanned
+        again upon the next trigger) while scans in progress are given timeout seconds to complete.
+        """
+        if not self._workers:
+            return
+        workers, self._workers = self._workers, []
+
+        discarded = 0
+        while True:
+            try:
+                job = self.queue.get_nowait()[2]
+            except Empty:
+                break
+            if job:
+                self.set_scan_state(job, None)
+                self.finish_trace(job, 'cancelled')
+                discarded += 1
+            self.queue.task_done()
+
+        with self._load_lock:
+            pending, self._pending = self._pending.values(), {}
+        for job in pending:
+            self.set_scan_state(job, None)
+            self.finish_trace(job, 'cancelled')
+        discarded += len(pending)
+
+        # one stop job per worker: they are served before any other job
+        for _ in workers:
+            self.queue.put((PRIORITY_STOP, next(self._sequence), None))
+        for worker in workers:
+            worker.join(timeout)
+
+        self.metric_set('load.queue', 0)
+        self.metric_set('load.pending', 0)
+        self.debug('scan workers stopped: %s queued proxy scans discarded' % discarded)
+
+    def _threaded_scan_worker(self):
+        """
+        Execute the proxy scans queued by doProxyScan (until a stop job is received).
         """
-        for k in self.services:
-            if self.services[k].scan(client):
-                self.log_proxy_connection(k, client)
-                client.kick(reason=self.settings['reason'], silent=True)
-                self.console.say(self.getMessage('client_rejected', {'client': client.name}))
+        while True:
+            try:
+                job = self.queue.get(timeout=5)[2]
+            except Empty:
+                # nothing to do: make sure we leave degraded modes even if no client connects
+                self.update_load_mode()
+                continue
+
+            if job is None:
+                self.queue.task_done()
                 return
 
-        self.debug('proxy scan completed for %s <@%s> : no proxy detected' % (client.name, client.id))
+            try:
+                if job.trace:
+                    job.trace.span('queue', job.time_add, time(), depth=self.queue.qsize())
+                if self.is_cancelled(job):
+                    self.debug('proxy scan cancelled for %s <@%s> : client disconnected' % (job.name, job.id))
+                    self.metric_incr('jobs.cancelled')
+                    self.finish_trace(job, 'cancelled')
+                elif self.tracer:
+                    self.set_scan_state(job, STATE_SCANNING)
+                    self.tracer.run(self._threaded_proxy_scan, job, job.remote)
+                else:
+                    self.set_scan_state(job, STATE_SCANNING)
+                    self._threaded_proxy_scan(job, job.remote)
+            except Exception, e:
+                self.error('unexpected error while scanning %s <@%s>: %s' % (job.name, job.id, e))
+                # let the next trigger scan the client again
+                self.set_scan_state(job, None)
+                self.finish_trace(job, 'error')
+            finally:
+                self.queue.task_done()
+
+            self.metric_set('load.queue', self.queue.qsize())
+            self.update_load_mode()
+
+    def _threaded_proxy_scan(self, job, remote=True):
+        """
+        Perform proxy server detection on the given client.
+        Will be executed by the scan workers so B3 won't hang on checking.
+        :param job: The ScanJob of the client to be scanned
+        :param remote: Whether to use proxy scanners contacting remote services
+        """
+        try:
+            n = ip2long(job.ip)
+        except ValueError:
+            n = None
+
+        cached = self.cache.get(n) if self.cache is not None and n is not None else None
+        if cached:
+            self.metric_incr('cache.hits')
+            if cached.prefix:
+                self.metric_incr('cache.prefix_hits')
+            self.debug('using cached verdict for %s <@%s> : %s' % (job.name, job.id, cached.ip))
+            detected, service = cached.detected, cached.service
+            if detected:
+                # a cached positive (address or network) still breaks the trust of the client
+                self.update_reputation(job, self.get_reputation(job), True)
+            if job.trace:
+                job.trace.span('cache', time(), hit=True, prefix=cached.prefix)
+        else:
+            if self.cache is not None and n is not None:
+                self.metric_incr('cache.misses')
+
+            # long standing clean clients connecting from their usual network don't need remote lookups
+            full = remote
+            reputation = self.get_reputation(job) if full else None
+            if reputation and self.is_trusted(job, reputation):
+                self.debug('skipping remote proxy scanners for %s <@%s> : trusted client' % (job.name, job.id))
+                self.metric_incr('reputation.trusted')
+                remote = False
+
+            detected, service = False, None
+            for k, scanner in self.services.items():
+                if scanner.remote and not remote:
+                    continue
+                start = time()
+                result = scanner.scan(job)
+                end = time()
+                if scanner.remote:
+                    self.record_latency(end - start)
+                if job.trace:
+                    job.trace.span('scan', start, end, service=k, remote=scanner.remote, detected=bool(result))
+                if result:
+                    detected, service = True, k
+                    break
+            # a clean verdict produced without remote scanners is only an approximation: don't cache it
+            if self.cache is not None and n is not None and (detected or remote):
+                prefix = self.cache.put(n, job.ip, detected, service)
+                if prefix:
+                    self.info('network %s flagged as proxy: %s distinct proxies detected' % (prefix.ip, self.cache.threshold))
+                    self.metric_incr('cache.prefixes')
+
+            if full:
+                self.update_reputation(job, reputation, detected, remote)
+            elif detected:
+                self.update_reputation(job, self.get_reputation(job), True)
+
+        if job.verdict:
+            job.verdict.set(detected, service)
+
+        self.set_scan_state(job, STATE_FLAGGED if detected else STATE_CLEAN)
+
+        if job.trace:
+            job.trace.span('verdict', time(), detected=detected, service=service, cached=bool(cached))
+
+        if detected:
+            self.reject_client(job, service)
+            self.finish_trace(job, STATE_FLAGGED)
+            return
+
+        self.debug('proxy scan completed for %s <@%s> : no proxy detected' % (job.name, job.id))
+        self.finish_trace(job, STATE_CLEAN)
+
+    def _threaded_shadow_scan(self, job):
+        """
+        Perform proxy server detection on the given client using the shadow scanners.
+        Results are only recorded: they never delay nor influence the authoritative scan.
+        """
+        results = []
+        for k, scanner in self.shadows.items():
+            if self.is_cancelled(job):
+                break
+            start = time()
+            try:
+                detected = bool(scanner.scan(job))
+            except Exception, e:
+                self.error('[shadow] proxy scanner service [%s] failed on %s <@%s>: %s' % (k, job.name, job.id, e))
+                continue
+            results.append((k, detected, time() - start))
+
+        # the authoritative scan may still be running: give it our own time budget
+        authoritative = job.verdict.wait(self.settings['shadowtimeout'])
+
+        with self._shadow_lock:
+            for k, detected, elapsed in results:
+                stats = self.shadow_stats.setdefault(k, {'scans': 0, 'positives': 0, 'disagreements': 0, 'latency': 0.0})
+                stats['scans'] += 1
+                stats['latency'] += elapsed
+                if detected:
+                    stats['positives'] += 1
+                if authoritative is not None and authoritative != detected:
+                    stats['disagreements'] += 1
+                self.debug('[shadow] proxy scan completed for %s <@%s> : [%s] %s in %.3fs (authoritative: %s)' % (
+                           job.name, job.id, k, detected, elapsed,
+                           'n/a' if authoritative is None else authoritative))
 
     def doProxyScan(self, event):
         """
         Execute a proxy scan on the connecting client..
         """
         client = event.client
+        # the sampling decision is taken once per client, upon authentication
+        sampled = client.cid in self._traces
+        trace = self._traces.pop(client.cid, None)
         if client.maxLevel >= self.settings['maxlevel']:
             self.debug('bypassing proxy scan for %s <@%s> : he is a high group level player' % (client.name, client.id))
+            return
+
+        if self.allowlist.match(client.ip, client.guid):
+            self.debug('bypassing proxy scan for %s <@%s> : he is in the allowlist' % (client.name, client.id))
+            self.metric_incr('allowlist.bypassed')
+            return
+
+        job = self.create_scan_job(client)
+        if not job:
+            self.debug('ignoring proxy scan request for %s <@%s> : already %s' % (client.name, client.id,
+                       self._sessions[client.cid].state))
+            return
+
+        if self.tracer:
+            job.trace = trace if sampled else self.tracer.start(job.time_add)
+            if trace and event.type != self.console.getEventID('EVT_CLIENT_AUTH'):
+                # the trace starts upon client authentication: the first span is the wait for the geolocation
+                job.trace.span('geolocation', job.trace.start, job.time_add, event=self.console.getEventName(event.type))
+
+        mode = self.update_load_mode()
+        if job.trace:
+            job.trace.attrs['mode'] = mode
+        if mode == MODE_LOCAL:
+            # local proxy scanners are fast: the job is served before the queued remote lookups
+            self.metric_incr('load.scans.local')
+            job.remote = False
+            self.queue_proxy_scan(job)
+        elif mode == MODE_CACHE:
+            self.metric_incr('load.scans.cache')
+            self.cache_proxy_scan(job)
         else:
-            proxycheck = Thread(target=self._threaded_proxy_scan, args=(client,))
-            proxycheck.setDaemon(True)
-            proxycheck.start()
+            self.queue_proxy_scan(job)
+
+    def onDisconnect(self, event):
+        """
+        Handle EVT_CLIENT_DISCONNECT.
+        """
+        cid = event.client.cid if event.client else event.data
+        # invalidate the session: queued and in-flight scans of this client are cancelled
+        with self._session_lock:
+            self._sessions.pop(cid, None)
+        with self._load_lock:
+            self._pending.pop(cid, None)
+        self._traces.pop(cid, None)
+        # the next client getting the slot must not resume the lookup of the previous one
+        self._lookups.pop(cid, None)
+
+    def create_scan_job(self, client):
+        """
+        Create the ScanJob of the given client, binding it to the current client session.
+        Will return None if the client has already been (or is being) scanned from the same ip address.
+        """
+        with self._session_lock:
+            session = self._sessions.get(client.cid)
+            if session and session.id == client.id:
+                if session.ip == client.ip and session.state is not None:
+                    return None
+                if session.ip != client.ip:
+                    self.debug('ip address of %s <@%s> changed from %s to %s : scanning again' % (client.name, client.id,
+                                                                                               session.ip, client.ip))
+                # a new token discards any scan still running for the previous ip address
+                session.ip = client.ip
+                session.token = next(self._tokens)
+            else:
+                session = ScanSession(client.id, client.ip, next(self._tokens))
+                self._sessions[client.cid] = session
+            session.state = STATE_PENDING
+            return ScanJob(client, session.token)
+
+    def set_scan_state(self, job, state):
+        """
+        Update the scan state of the session the given job belongs to (if the job is still current).
+        """
+        with self._session_lock:
+            session = self._sessions.get(job.cid)
+            if session and session.token == job.token:
+                session.state = state
+
+    def is_cancelled(self, job):
+        """
+        Return True if the given job is stale: the client disconnected or its ip address changed.
+        """
+        session = self._sessions.get(job.cid)
+        return session is None or session.token != job.token
+
+    def get_job_client(self, job):
+        """
+        Return the client the given job belongs to or None if the client disconnected.
+        """
+        if self.is_cancelled(job):
+            return None
+        client = self.console.clients.getByCID(job.cid)
+        if not client or client.id != job.id:
+            return None
+        return client
+
+    def reject_client(self, job, service):
+        """
+        Store the proxy connection of the given job and kick its client (if still connected).
+        """
+        start = time()
+        self.log_proxy_connection(service, job)
+        if job.trace:
+            job.trace.span('store', start, time())
+
+        client = self.get_job_client(job)
+        if not client:
+            self.debug('not kicking %s <@%s> : client disconnected before the proxy scan completed' % (job.name, job.id))
+            return
+
+        start = time()
+        client.kick(reason=self.settings['reason'], silent=True)
+        if job.trace:
+            job.trace.span('kick', start, time())
+
+        start = time()
+        self.console.say(self.getMessage('client_rejected', {'client': job.name}))
+        if job.trace:
+            job.trace.span('announce', start, time())
+
+    def queue_proxy_scan(self, job):
+        """
+        Queue the proxy scan of the given job (and its shadow scan if needed).
+        """
+        if self.shadows and job.remote:
+            job.verdict = ScanVerdict()
+            shadowcheck = Thread(target=self._threaded_shadow_scan, args=(job,))
+            shadowcheck.setDaemon(True)
+            shadowcheck.start()
+
+        self.queue.put((PRIORITY_REMOTE if job.remote else PRIORITY_LOCAL, next(self._sequence), job))
+        self.metric_set('load.queue', self.queue.qsize())
+
+    def cache_proxy_scan(self, job):
+        """
+        Enforce the cached verdict of the given job (if any) without scanning.
+        Jobs with no cached verdict are held pending until the load drops (if configured to).
+        """
+        try:
+            cached = self.cache.get(ip2long(job.ip)) if self.cache is not None else None
+        except ValueError:
+            cached = None
+
+        if cached:
+            self.metric_incr('cache.hits')
+            self.set_scan_state(job, STATE_FLAGGED if cached.detected else STATE_CLEAN)
+            if job.trace:
+                job.trace.span('verdict', time(), detected=cached.detected, service=cached.service, cached=True)
+            if cached.detected:
+                self.update_reputation(job, self.get_reputation(job), True)
+                self.reject_client(job, cached.service)
+            self.finish_trace(job, STATE_FLAGGED if cached.detected else STATE_CLEAN)
+            return
+
+        if self.settings['holdpending']:
+            self.debug('holding proxy scan for %s <@%s> : scan pipeline is overloaded' % (job.name, job.id))
+            with self._load_lock:
+                self._pending[job.cid] = job
+            self.metric_set('load.pending', len(self._pending))
+        else:
+            self.debug('skipping proxy scan for %s <@%s> : scan pipeline is overloaded' % (job.name, job.id))
+            self.metric_incr('load.skipped')
+            # the client has not been scanned: let the next trigger try again
+            self.set_scan_state(job, None)
+            self.finish_trace(job, 'skipped')
+
+    def record_latency(self, elapsed, window=60):
+        """
+        Record the duration of a remote proxy scanner call.
+        """
+        now = time()
+        with self._load_lock:
+            self._latencies.append((now, elapsed))
+            while self._latencies and self._latencies[0][0] < now - window:
+                self._latencies.popleft()
+
+    def get_latency(self, window=60):
+        """
+        Return the average duration of the remote proxy scanner calls of the last window seconds.
+        """
+        now = time()
+        with self._load_lock:
+            while self._latencies and self._latencies[0][0] < now - window:
+                self._latencies.popleft()
+            if not self._latencies:
+                return 0.0
+            return sum(x[1] for x in self._latencies) / len(self._latencies)
+
+    def update_load_mode(self):
+        """
+        Switch the scan pipeline load mode according to the queue depth and the remote scanners latency.
+        Degraded modes are left only once the load dropped below half the watermark that triggered them.
+        :return: The current load mode
+        """
+        depth = self.queue.qsize()
+        latency = self.get_latency()
+        high, critical, slow = self.settings['queuehigh'], self.settings['queuecritical'], self.settings['latencyhigh']
+        levels = [MODE_NORMAL, MODE_LOCAL, MODE_CACHE]
+
+        with self._load_lock:
+            current = levels.index(self.load_mode)
+            if critical and depth >= critical:
+                level = 2
+            elif (high and depth >= high) or (slow and latency >= slow):
+                level = 1
+            else:
+                level = 0
+
+            if current == 2 and level < 2 and critical and depth > critical // 2:
+                level = 2
+            if current > 0 and level == 0 and ((high and depth > high // 2) or (slow and latency > slow / 2)):
+                level = 1
+
+            previous, self.load_mode = self.load_mode, levels[level]
+            pending = []
+            if self.load_mode == MODE_NORMAL and self._pending:
+                pending, self._pending = self._pending.values(), {}
+
+        if self.load_mode != previous:
+            self.info('scan pipeline switched from %s to %s mode (queue depth: %s, latency: %.3fs)' % (
+                      previous, self.load_mode, depth, latency))
+            self.metric_incr('load.transitions.%s' % self.load_mode)
+            self.metric_set('load.mode', self.load_mode)
+
+        # scan the clients which have been held while the pipeline was overloaded
+        for job in pending:
+            if not self.is_cancelled(job):
+                self.queue_proxy_scan(job)
+        if pending:
+            self.metric_set('load.pending', 0)
+
+        return self.load_mode
+
+    def save_cache(self):
+        """
+        Write the cached verdicts to the cache file (if configured).
+        Verdicts stored in the file meanwhile (e.g. by audit.py --populate) are preserved.
+        """
+        if self.cache is None or not self.settings['cachefile']:
+            return
+        try:
+            saved = self.cache.save(self.settings['cachefile'], merge=True)
+            self.debug('saved %s cached verdicts in %s' % (saved, self.settings['cachefile']))
+        except (IOError, OSError), e:
+            self.error('could not save cached verdicts in %s: %s' % (self.settings['cachefile'], e))
+
+    def finish_trace(self, job, outcome):
+        """
+        Write the trace of the given job (if any) to the trace file.
+        """
+        if job.trace:
+            self.tracer.finish(job.trace, outcome=outcome, client=job.id, ip=job.ip)
+            job.trace = None
 
     def onAuth(self, event):
         """
         Handle EVT_CLIENT_AUTH.
         """
+        if self.tracer:
+            # store unsampled clients too (as None) so the scan doesn't roll the dice again
+            self._traces[event.client.cid] = self.tracer.start()
+
         # execute only if geolocation plugin is disabled, otherwise wait for it to produce its events
         if not self.settings['services']['geolocationplugin']['enabled']:
             self.doProxyScan(event)
 
+    def onStop(self, event):
+        """
+        Handle EVT_STOP.
+        """
+        self.stop_workers()
+        if self.feeds:
+            self.feeds.stop()
+        if self.tracer:
+            self.tracer.close()
+        self.save_cache()
+
     def onPluginDisabled(self, event):
         """
         Handle EVT_PLUGIN_DISABLED.
@@ -231,13 +1126,212 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
     #                                                                                                                  #
     ####################################################################################################################
 
+    def get_sql_path(self, name):
+        """
+        Return the path of the given SQL script for the current storage protocol.
+        """
+        external_dir = self.console.config.get_external_plugins_dir()
+        return os.path.join(external_dir, 'proxyfilter', 'sql', self.console.storage.dsnDict['protocol'], name)
+
+    def upgrade_tables(self):
+        """
+        Upgrade the database tables created by previous versions of the plugin.
+        """
+        try:
+            self.console.storage.query(self.sql['q6']).close()
+        except Exception:
+            self.info('upgrading proxies table: adding binary ip column...')
+            self.console.storage.queryFromFile(self.get_sql_path('update_1.6.sql'))
+
+        # fill the binary ip column of old records without holding B3 startup
+        backfill = Thread(target=self._threaded_ip_backfill)
+        backfill.setDaemon(True)
+        backfill.start()
+
+    def _threaded_ip_backfill(self, chunk=500):
+        """
+        Compute the binary ip column of the records stored by previous versions of the plugin.
+        """
+        last, total = 0, 0
+        while True:
+            rows = []
+            cursor = self.console.storage.query(self.sql['q7'] % (last, chunk))
+            while not cursor.EOF:
+                rows.append(cursor.getRow())
+                cursor.moveNext()
+            cursor.close()
+
+            if not rows:
+                break
+
+            for r in rows:
+                last = int(r['id'])
+                ip_bin = self.sql_ip(r['ip'])
+                if ip_bin != 'NULL':
+                    self.console.storage.query(self.sql['q8'] % (ip_bin, last))
+                    total += 1
+
+        if total:
+            self.info('binary ip column computed for %s proxies table records' % total)
+
+    def sql_ip(self, ip):
+        """
+        Return the SQL literal storing the given address (string or integer) in a binary ip column.
+        Will return NULL if the given string is not a valid ip address.
+        """
+        try:
+            n = ip if isinstance(ip, (int, long)) else ip2long(ip)
+        except ValueError:
+            return 'NULL'
+
+        data = long2bytes(n).encode('hex')
+        if self.console.storage.dsnDict['protocol'] == 'postgresql':
+            return "DECODE('%s', 'hex')" % data
+        return "X'%s'" % data
+
+    def load_allowlist(self):
+        """
+        Load the allowlist from the database.
+        """
+        entries = []
+        cursor = self.console.storage.query(self.sql['q14'])
+        while not cursor.EOF:
+            entry = cursor.getRow()['entry']
+            try:
+                entries.append(normalize_entry(entry))
+            except ValueError:
+                self.warning('invalid allowlist entry found in the database: %s' % entry)
+            cursor.moveNext()
+        cursor.close()
+        self.allowlist = Allowlist(entries)
+        self.debug('loaded %s allowlist entries' % len(self.allowlist))
+
     def log_proxy_connection(self, service, client):
         """
         Log a proxy connection in the database
+        :param client: The client (or ScanJob) connected through a proxy
         """
-        self.console.storage.query(self.sql['q1'] % (client.id, service, client.ip, time()))
+        self.console.storage.query(self.sql['q1'] % (client.id, service, client.ip, self.sql_ip(client.ip), time()))
         self.debug('stored new proxy connection for %s <@%s> : [%s] %s' % (client.name, client.id, service, client.ip))
 
+    def get_proxy_history(self, lookup, limit):
+        """
+        Return a page of proxy detections matching the given lookup.
+        Pages are retrieved with keyset pagination so every page is an indexed seek, however deep.
+        """
+        if lookup['client_id'] is not None:
+            query = self.sql['q10'] % (lookup['client_id'], lookup['cursor'][1], limit)
+        else:
+            last = self.sql_ip(lookup['cursor'][0])
+            query = self.sql['q9'] % (self.sql_ip(lookup['low']), self.sql_ip(lookup['high']),
+                                      last, last, lookup['cursor'][1], limit)
+
+        rows = []
+        cursor = self.console.storage.query(query)
+        while not cursor.EOF:
+            rows.append(cursor.getRow())
+            cursor.moveNext()
+        cursor.close()
+        return rows
+
+    def get_reputation(self, job):
+        """
+        Return the scan history of the client the given job belongs to (None if the client was never scanned).
+        """
+        if not self.settings['trustscans'] or not job.id:
+            return None
+        cursor = self.console.storage.query(self.sql['q11'] % int(job.id))
+        reputation = cursor.getRow() if not cursor.EOF else None
+        cursor.close()
+        return reputation or None
+
+    def is_trusted(self, job, reputation):
+        """
+        Return True if the client the given job belongs to has a long enough clean scan history
+        from the same network and has not been flagged recently.
+        """
+        try:
+            prefix = format_network(*prefix_network(ip2long(job.ip)))
+        except ValueError:
+            return False
+
+        last_flag = int(reputation['last_flag'])
+        return int(reputation['clean_streak']) >= self.settings['trustscans'] and \
+            int(reputation['stable_streak']) >= self.settings['truststable'] and \
+            reputation['ip_prefix'] == prefix and \
+            (not last_flag or time() - last_flag >= self.settings['trustage'] * 86400)
+
+    def update_reputation(self, job, reputation, detected, remote=True):
+        """
+        Update the scan history of the client the given job belongs to with the given verdict.
+        :param reputation: The scan history as returned by get_reputation
+        :param remote: Whether the verdict comes from a full scan (only those extend the clean streak)
+        """
+        if not self.settings['trustscans'] or not job.id:
+            return
+
+        try:
+            prefix = format_network(*prefix_network(ip2long(job.ip)))
+        except ValueError:
+            return
+
+        now = int(time())
+        if not reputation:
+            self.console.storage.query(self.sql['q12'] % (int(job.id), prefix, 1 if remote and not detected else 0, 1,
+                                                          now if detected else 0, now))
+            return
+
+        # the clean streak is reset by any positive scan and extended by full clean scans only,
+        # the stable one is reset by any change of network
+        clean_streak = 0 if detected else int(reputation['clean_streak']) + (1 if remote else 0)
+        stable_streak = int(reputation['stable_streak']) + 1 if reputation['ip_prefix'] == prefix else 1
+        last_flag = now if detected else int(reputation['last_flag'])
+        self.console.storage.query(self.sql['q13'] % (prefix, clean_streak, stable_streak, last_flag, now, int(job.id)))
+
+    def metric_incr(self, name, value=1):
+        """
+        Increment the given metric counter.
+        """
+        with self._metrics_lock:
+            self.metrics[name] = self.metrics.get(name, 0) + value
+
+    def metric_set(self, name, value):
+        """
+        Set the value of the given metric.
+        """
+        with self._metrics_lock:
+            self.metrics[name] = value
+
+    def register_proxy_service(self, keyword, obj):
+        """
+        Publish a proxy scanner service instance replacing any previous instance of the same service.
+        """
+        with self._registry_lock:
+            previous = self.services.get(keyword) or self.shadows.get(keyword)
+            services = dict((k, v) for k, v in self.services.iteritems() if k != keyword)
+            shadows = dict((k, v) for k, v in self.shadows.iteritems() if k != keyword)
+            if obj.shadow:
+                shadows[keyword] = obj
+            else:
+                services[keyword] = obj
+            self.services, self.shadows = services, shadows
+        if previous is not None and previous is not obj:
+            previous.close()
+
+    def unregister_proxy_service(self, keyword):
+        """
+        Withdraw a proxy scanner service instance and release its resources.
+        :return: True if the service was registered, False otherwise
+        """
+        with self._registry_lock:
+            obj = self.services.get(keyword) or self.shadows.get(keyword)
+            if obj is None:
+                return False
+            self.services = dict((k, v) for k, v in self.services.iteritems() if k != keyword)
+            self.shadows = dict((k, v) for k, v in self.shadows.iteritems() if k != keyword)
+        obj.close()
+        return True
+
     def init_proxy_service(self, keyword):
         """
         Initialize a proxy scanner service instance.
@@ -245,7 +1339,8 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
         try:
             self.debug('initializing proxy scanner service: %s...' % keyword)
             obj = self.settings['services'][keyword]['class'](self, keyword, self.settings['services'][keyword]['url'])
-            self.services[keyword] = obj
+            obj.shadow = self.settings['services'][keyword]['shadow']
+            self.register_proxy_service(keyword, obj)
             return True
         except Exception, e:
             self.warning('could not initialize proxy scanner service [%s]: %s' % (keyword, e))
@@ -262,7 +1357,7 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
         Display the list of available proxy checker services
         """
         services = []
-        for k in self.settings['services']:
+        for k in sorted(self.settings['services']):
             enabled = self.settings['services'][k]['enabled']
             services.append('%s%s' % ('^2' if enabled else '^1',k))
         cmd.sayLoudOrPM(client, self.getMessage('proxy_list', {'services': '^7, '.join(services)}))
@@ -296,7 +1391,7 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
         if option == 'on':
 
             # if already operational
-            if service in self.services:
+            if service in self.services or service in self.shadows:
                 client.message('^7proxy service ^3%s ^7is already ^2ON' % service)
                 return
 
@@ -310,20 +1405,52 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
 
         elif option == 'off':
 
-            # if not operational
-            if service not in self.services:
+            # shut it down (if operational)
+            if not self.unregister_proxy_service(service):
                 client.message('^7proxy service ^3%s ^7is already ^1OFF' % service)
                 return
 
-            # shut it down
-            del self.services[service]
             self.settings['services'][service]['enabled'] = False
             client.message('^7proxy service ^3%s ^7is now ^1OFF' % service)
 
     def cmd_proxystats(self, data, client, cmd=None):
         """
-        Display statistics about detected proxies
+        [<network>] - display statistics about detected proxies
         """
+        if data:
+            try:
+                low, high = parse_network(data.strip())
+            except ValueError:
+                client.message('^7invalid network specified, try ^3!^7help proxystats')
+                return
+
+            # both queries are indexed range scans over the binary ip column
+            cursor = self.console.storage.query(self.sql['q4'] % (self.sql_ip(low), self.sql_ip(high)))
+            cmd.sayLoudOrPM(client, self.getMessage('stats_network_proxies', {'count': cursor.getRow()['total'],
+                                                                              'network': format_network(low, high)}))
+            cursor.close()
+
+            # group by /24 (IPv4) or /48 (IPv6) prefixes: 12 bytes of the IPv4 mapped prefix plus 3,
+            # each address family on its own since the group size differs
+            prefixes = {}
+            for part_low, part_high, ipv4 in split_families(low, high):
+                cursor = self.console.storage.query(self.sql['q5'] % (self.sql_ip(part_low), self.sql_ip(part_high),
+                                                                      15 if ipv4 else 6, 5))
+                while not cursor.EOF:
+                    r = cursor.getRow()
+                    try:
+                        prefix = format_network(*prefix_network(ip2long(r['ip'])))
+                    except ValueError:
+                        prefix = None
+                    if prefix:
+                        prefixes[prefix] = prefixes.get(prefix, 0) + int(r['total'])
+                    cursor.moveNext()
+                cursor.close()
+
+            for prefix, total in sorted(prefixes.iteritems(), key=lambda x: (-x[1], x[0]))[:5]:
+                cmd.sayLoudOrPM(client, self.getMessage('stats_prefix_pattern', {'count': total, 'prefix': prefix}))
+            return
+
         cursor = self.console.storage.query(self.sql['q2'])
         cmd.sayLoudOrPM(client, self.getMessage('stats_count_proxies', {'count': cursor.getRow()['total']}))
         cursor.close()
@@ -333,4 +1460,159 @@ class ProxyfilterPlugin(b3.plugin.Plugin):
             r = cursor.getRow()
             cmd.sayLoudOrPM(client, self.getMessage('stats_detail_pattern', {'count': r['total'], 'service': r['service']}))
             cursor.moveNext()
-        cursor.close()
\ No newline at end of file
+        cursor.close()
+
+    def cmd_proxyshadow(self, data, client, cmd=None):
+        """
+        Display statistics about proxy scanner services running in shadow mode
+        """
+        shadows = self.shadows
+        if not shadows and not self.shadow_stats:
+            cmd.sayLoudOrPM(client, self.getMessage('shadow_no_services'))
+            return
+
+        with self._shadow_lock:
+            for k in sorted(set(shadows.keys()) | set(self.shadow_stats.keys())):
+                stats = self.shadow_stats.get(k, {'scans': 0, 'positives': 0, 'disagreements': 0, 'latency': 0.0})
+                latency = int(stats['latency'] * 1000 / stats['scans']) if stats['scans'] else 0
+                cmd.sayLoudOrPM(client, self.getMessage('shadow_stats_pattern', {'service': k,
+                                                                                 'scans': stats['scans'],
+                                                                                 'positives': stats['positives'],
+                                                                                 'disagreements': stats['disagreements'],
+                                                                                 'latency': latency}))
+
+    def cmd_proxymetrics(self, data, client, cmd=None):
+        """
+        [<prefix>] - display the plugin metrics
+        """
+        with self._metrics_lock:
+            metrics = sorted((k, v) for k, v in self.metrics.items() if not data or k.startswith(data.strip()))
+
+        if not metrics:
+            cmd.sayLoudOrPM(client, self.getMessage('metrics_empty'))
+            return
+
+        for name, value in metrics:
+            cmd.sayLoudOrPM(client, self.getMessage('metrics_pattern', {'name': name, 'value': value}))
+
+    def cmd_proxyprefixes(self, data, client, cmd=None):
+        """
+        Display the networks flagged because of multiple proxy detections
+        """
+        prefixes = self.cache.prefixes() if self.cache is not None else []
+        if not prefixes:
+            cmd.sayLoudOrPM(client, self.getMessage('prefixes_empty'))
+            return
+
+        now = time()
+        for verdict, flagged in prefixes:
+            cmd.sayLoudOrPM(client, self.getMessage('prefixes_pattern', {'network': verdict.ip,
+                                                                         'count': flagged,
+                                                                         'service': verdict.service,
+                                                                         'expire': minutesStr((verdict.time_expire - now) / 60.0)}))
+
+    def cmd_proxyallow(self, data, client, cmd=None):
+        """
+        <add|del|list> [<ip|network|guid>] - manage the clients which are never scanned
+        """
+        if not data:
+            client.message('^7missing data, try ^3!^7help proxyallow')
+            return
+
+        r = re.compile(r'''^(?P<option>add|del|list)(?:\s+(?P<entry>\S+))?$''', re.IGNORECASE)
+        m = r.match(data.strip())
+        if not m or (m.group('option').lower() != 'list' and not m.group('entry')):
+            client.message('^7invalid data, try ^3!^7help proxyallow')
+            return
+
+        option = m.group('option').lower()
+        if option == 'list':
+            if not self.allowlist.entries:
+                cmd.sayLoudOrPM(client, self.getMessage('allow_empty'))
+                return
+            cmd.sayLoudOrPM(client, self.getMessage('allow_list', {'entries': ', '.join(sorted(self.allowlist.entries))}))
+            return
+
+        try:
+            entry = normalize_entry(m.group('entry'))
+        except ValueError:
+            client.message('^7invalid ip address, network or guid specified, try ^3!^7help proxyallow')
+            return
+
+        if option == 'add':
+            if entry in self.allowlist.entries:
+                client.message('^3%s ^7is already in the allowlist' % entry)
+                return
+            self.console.storage.query(self.sql['q15'] % (entry, client.id or 0, time()))
+            self.allowlist = self.allowlist.add(entry)
+            client.message('^3%s ^7has been ^2added ^7to the allowlist' % entry)
+        else:
+            if entry not in self.allowlist.entries:
+                client.message('^3%s ^7is not in the allowlist' % entry)
+                return
+            self.console.storage.query(self.sql['q16'] % entry)
+            self.allowlist = self.allowlist.remove(entry)
+            client.message('^3%s ^7has been ^1removed ^7from the allowlist' % entry)
+
+    def cmd_proxylookup(self, data, client, cmd=None):
+        """
+        <ip|@id|network|next> - lookup the proxy detection history
+        """
+        if not data:
+            client.message('^7missing data, try ^3!^7help proxylookup')
+            return
+
+        data = data.strip()
+        if data.lower() == 'next':
+            lookup = self._lookups.get(client.cid)
+            if not lookup:
+                client.message('^7no lookup in progress, try ^3!^7help proxylookup')
+                return
+        else:
+            if data.startswith('@'):
+                if not data[1:].isdigit():
+                    client.message('^7invalid client id specified, try ^3!^7help proxylookup')
+                    return
+                lookup = {'target': data, 'client_id': int(data[1:]), 'cursor': (None, 0)}
+            else:
+                try:
+                    low, high = parse_network(data)
+                except ValueError:
+                    client.message('^7invalid data, try ^3!^7help proxylookup')
+                    return
+
+                lookup = {'target': data, 'client_id': None, 'low': low, 'high': high, 'cursor': (low, 0)}
+
+                # answer from the verdict cache first: it holds the most recent scan results
+                if self.cache is not None:
+                    if low == high:
+                        cached = self.cache.get(low)
+                        if cached:
+                            status = '^1proxy ^7(^3%s^7)' % cached.service if cached.detected else '^2clean'
+                            cmd.sayLoudOrPM(client, self.getMessage('lookup_cached', {'ip': cached.ip, 'verdict': status}))
+                    else:
+                        flagged = len([x for x in self.cache.items(low, high) if x[1].detected])
+                        cmd.sayLoudOrPM(client, self.getMessage('lookup_cached_network', {'count': flagged,
+                                                                                          'network': format_network(low, high)}))
+
+        rows = self.get_proxy_history(lookup, self.settings['lookuplimit'] + 1)
+        if not rows and lookup['cursor'][1] == 0:
+            cmd.sayLoudOrPM(client, self.getMessage('lookup_no_results', {'target': lookup['target']}))
+            self._lookups.pop(client.cid, None)
+            return
+
+        for r in rows[:self.settings['lookuplimit']]:
+            cmd.sayLoudOrPM(client, self.getMessage('lookup_pattern', {'id': r['id'],
+                                                                       'ip': r['ip'],
+                                                                       'client': r['client_id'],
+                                                                       'service': r['service'],
+                                                                       'time': self.console.formatTime(int(r['time_add']))}))
+
+        if len(rows) > self.settings['lookuplimit']:
+            # remember where we stopped: next page starts right after the last displayed record
+            last = rows[self.settings['lookuplimit'] - 1]
+            lookup['cursor'] = (None if lookup['client_id'] is not None else ip2long(last['ip']), int(last['id']))
+            self._lookups[client.cid] = lookup
+            cmd.sayLoudOrPM(client, self.getMessage('lookup_more'))
+        else:
+            self._lookups.pop(client.cid, None)
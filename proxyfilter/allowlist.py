@@ -0,0 +1,94 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import re
+
+from feeds import FeedIndex
+from iputils import format_network
+from iputils import ip2long
+from iputils import long2ip
+from iputils import parse_network
+
+GUID_PATTERN = re.compile(r'^[0-9a-z]{4,64}$', re.IGNORECASE)
+
+
+def normalize_entry(entry):
+    """
+    Return the canonical form of the given allowlist entry (ip address, network in CIDR notation or client guid).
+    :raise ValueError: If the given entry is not valid
+    """
+    entry = entry.strip()
+    try:
+        low, high = parse_network(entry)
+    except ValueError:
+        if not GUID_PATTERN.match(entry):
+            raise ValueError('invalid allowlist entry: %s' % entry)
+        return entry.upper()
+    return long2ip(low) if low == high and '/' not in entry else format_network(low, high)
+
+
+class Allowlist(object):
+    """
+    Immutable index of allowlisted ip addresses, networks and client guids: addresses and guids are
+    matched with a hash lookup, networks with a bisect over sorted non overlapping ranges (see FeedIndex).
+    Changes are applied by building a new index and swapping the reference (copy on write).
+    """
+    def __init__(self, entries=()):
+        """
+        Object constructor.
+        :param entries: Iterable of normalized entries (see normalize_entry)
+        """
+        self.entries = frozenset(entries)
+        addresses, networks, guids = [], [], []
+        for entry in self.entries:
+            if '/' in entry:
+                networks.append(parse_network(entry))
+            elif '.' in entry or ':' in entry:
+                addresses.append(ip2long(entry))
+            else:
+                guids.append(entry)
+        self.index = FeedIndex(addresses, networks)
+        self.guids = frozenset(guids)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def match(self, ip, guid=None):
+        """
+        Return True if the given ip address or guid is allowlisted, False otherwise.
+        """
+        if guid and guid.upper() in self.guids:
+            return True
+        if not ip or not len(self.index):
+            return False
+        try:
+            return ip2long(ip) in self.index
+        except ValueError:
+            return False
+
+    def add(self, entry):
+        """
+        Return a new Allowlist including the given normalized entry.
+        """
+        return Allowlist(self.entries | set([entry]))
+
+    def remove(self, entry):
+        """
+        Return a new Allowlist without the given normalized entry.
+        """
+        return Allowlist(self.entries - set([entry]))
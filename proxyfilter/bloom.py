@@ -0,0 +1,261 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import heapq
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+from bisect import bisect_left
+from hashlib import md5
+from iputils import bytes2long
+from iputils import long2bytes
+from iputils import parse_network
+
+
+def iter_feed(path):
+    """
+    Iterate over the entries of a feed file: one entry per line, '#' starts a comment.
+    """
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                yield line.split()[0].lower()
+
+
+def iter_records(f, size=16):
+    """
+    Iterate over the fixed size records of the given file (from the current position).
+    """
+    while True:
+        data = f.read(size * 4096)
+        if not data:
+            return
+        for i in xrange(0, len(data), size):
+            yield data[i:i + size]
+
+
+class _Records(object):
+    """
+    Sequence view over the packed addresses of a memory map, so they can be searched with bisect.
+    """
+    def __init__(self, data, offset, count, size=16):
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.size = size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.offset + i * self.size
+        return self.data[start:start + self.size]
+
+
+class BloomFilter(object):
+    """
+    Read only Bloom filter backed by a memory mapped file.
+    The file holds the bit array followed by the sorted list of the feed addresses (16 bytes each, see
+    iputils.long2bytes): a negative lookup is definitive while a positive one may be a false positive,
+    which is ruled out with a binary search over the sorted addresses (see exact).
+    Only single addresses are supported: networks belong to the local feeds directory (see FeedIndex).
+    """
+    MAGIC = 'B3BF'
+    VERSION = 2
+    HEADER = struct.Struct('!4sBQBQ')  # magic, version, number of bits, number of hashes, number of entries
+    RECORD = 16
+
+    def __init__(self, path):
+        """
+        Object constructor.
+        :param path: The path of the filter file
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+
+        magic, version, self.bits, self.hashes, self.entries = self.HEADER.unpack(self._map[:self.HEADER.size])
+        offset = self.HEADER.size + (self.bits + 7) // 8
+        if magic != self.MAGIC or version != self.VERSION or len(self._map) < offset + self.entries * self.RECORD:
+            self.close()
+            raise ValueError('invalid bloom filter file: %s' % path)
+
+        self._records = _Records(self._map, offset, self.entries, self.RECORD)
+
+    def __contains__(self, n):
+        """
+        Return False if the given address (as integer) is surely not in the filter, True if it probably is.
+        """
+        offset = self.HEADER.size
+        for position in self.positions(n, self.bits, self.hashes):
+            if not ord(self._map[offset + (position >> 3)]) & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.entries
+
+    def exact(self, n):
+        """
+        Return True if the given address (as integer) is listed in the feed: binary search over the sorted addresses.
+        """
+        key = long2bytes(n)
+        i = bisect_left(self._records, key)
+        return i < self.entries and self._records[i] == key
+
+    def close(self):
+        """
+        Release the memory map and the underlying file.
+        """
+        self._map.close()
+        self._file.close()
+
+    @staticmethod
+    def positions(n, bits, hashes):
+        """
+        Compute the bit positions of the given address (double hashing on a single md5 digest).
+        The packed address is hashed so that every textual representation of the address matches.
+        """
+        h1, h2 = struct.unpack('<QQ', md5(long2bytes(n)).digest())
+        return [(h1 + i * h2) % bits for i in xrange(hashes)]
+
+    @staticmethod
+    def dimension(entries, errorrate):
+        """
+        Return the number of bits and hash functions needed to hold the
+        given number of entries with the given false positive rate.
+        """
+        entries = max(entries, 1)
+        bits = int(math.ceil(-entries * math.log(errorrate) / (math.log(2) ** 2)))
+        hashes = max(1, int(round(float(bits) / entries * math.log(2))))
+        return bits, hashes
+
+    @classmethod
+    def build(cls, feed, path, errorrate=0.001, chunk=1000000):
+        """
+        Build the filter file of the given feed. Addresses are sorted in runs of chunk entries which are
+        then merged (external sort) and the file is written through a memory map, so that neither the
+        feed nor the filter ever need to be held in memory.
+        :param feed: The path of the feed file
+        :param path: The path of the filter file to create
+        :param errorrate: The desired false positive rate
+        :param chunk: The number of addresses sorted in memory at once
+        :return: The number of addresses stored in the filter and the number of skipped (invalid or network) entries
+        """
+        runs = []
+        total, skipped = 0, 0
+        try:
+            batch = []
+            for entry in iter_feed(feed):
+                try:
+                    low, high = parse_network(entry)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if low != high:
+                    # networks can't be hashed: they are supported by the localfeed service only
+                    skipped += 1
+                    continue
+                batch.append(long2bytes(low))
+                total += 1
+                if len(batch) >= chunk:
+                    runs.append(cls._write_run(batch))
+                    batch = []
+            if batch:
+                runs.append(cls._write_run(batch))
+
+            # the filter is sized on the number of addresses before removing duplicates (upper bound)
+            bits, hashes = cls.dimension(total, errorrate)
+            offset = cls.HEADER.size + (bits + 7) // 8
+
+            # write in a temporary file and rename it so readers never see a half built filter
+            fd, tmp = tempfile.mkstemp(prefix='%s.' % os.path.basename(path), suffix='.tmp',
+                                       dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                entries = cls._write_records(fd, runs, offset)
+                with open(tmp, 'r+b') as f:
+                    f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, bits, hashes, entries))
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE)
+                    try:
+                        records = _Records(m, offset, entries, cls.RECORD)
+                        for i in xrange(entries):
+                            for position in cls.positions(bytes2long(records[i]), bits, hashes):
+                                index = cls.HEADER.size + (position >> 3)
+                                m[index] = chr(ord(m[index]) | (1 << (position & 7)))
+                        m.flush()
+                    finally:
+                        m.close()
+            except Exception:
+                os.remove(tmp)
+                raise
+        finally:
+            for x in runs:
+                x.close()
+
+        if os.path.exists(path) and os.name == 'nt':
+            os.remove(path)
+        os.rename(tmp, path)
+        return entries, skipped
+
+    @classmethod
+    def _write_records(cls, fd, runs, offset):
+        """
+        Merge the given sorted runs into the given file descriptor starting at the given offset, dropping duplicates.
+        :return: The number of addresses written
+        """
+        entries = 0
+        with os.fdopen(fd, 'wb') as f:
+            # the header and the bit array are left as a hole: it reads as zeros
+            f.seek(offset)
+            previous = None
+            for record in heapq.merge(*[iter_records(x, cls.RECORD) for x in runs]):
+                if record != previous:
+                    f.write(record)
+                    entries += 1
+                    previous = record
+            f.truncate(offset + entries * cls.RECORD)
+        return entries
+
+    @classmethod
+    def _write_run(cls, batch):
+        """
+        Write the given addresses, sorted, into a temporary file and return it (rewound).
+        """
+        batch.sort()
+        f = tempfile.TemporaryFile()
+        f.write(''.join(batch))
+        f.seek(0)
+        return f
+
+
+if __name__ == '__main__':
+    # build the filter file offline: python bloom.py <feed> <filter> [errorrate]
+    if len(sys.argv) < 3:
+        print 'usage: %s <feed> <filter> [errorrate]' % sys.argv[0]
+        sys.exit(1)
+    entries, skipped = BloomFilter.build(sys.argv[1], sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 0.001)
+    print 'bloom filter %s built: %d addresses (%d invalid or network entries skipped)' % (sys.argv[2], entries, skipped)
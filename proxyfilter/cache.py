@@ -0,0 +1,253 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import json
+import os
+import tempfile
+
+from collections import OrderedDict
+from iputils import format_network
+from iputils import ip2long
+from iputils import prefix_network
+from threading import Lock
+from time import time
+
+
+class Verdict(object):
+    """
+    A cached proxy scan result: the ip attribute holds the network (CIDR notation) of prefix verdicts.
+    """
+    __slots__ = ('ip', 'detected', 'service', 'time_add', 'time_expire', 'prefix')
+
+    def __init__(self, ip, detected, service, time_add, time_expire, prefix=False):
+        """
+        Object constructor.
+        """
+        self.ip = ip
+        self.detected = detected
+        self.service = service
+        self.time_add = time_add
+        self.time_expire = time_expire
+        self.prefix = prefix
+
+
+class VerdictCache(object):
+    """
+    Thread safe, size bounded (least recently used eviction) cache of proxy scan results.
+    Entries are keyed on the address as an integer of the IPv6 address space (see iputils).
+    Positive verdicts are also aggregated by prefix (/24 for IPv4, /48 for IPv6): once enough distinct
+    addresses of the same prefix are flagged, the whole prefix gets a verdict of its own.
+    """
+    def __init__(self, ttl=3600, size=10000, threshold=0, prefixttl=86400):
+        """
+        Object constructor.
+        :param ttl: The amount of seconds a verdict is valid for
+        :param size: The maximum number of verdicts held in the cache
+        :param threshold: The number of distinct flagged addresses needed to flag a prefix (0 disables)
+        :param prefixttl: The amount of seconds a prefix verdict (and a flagged address sighting) is valid for
+        """
+        self.ttl = ttl
+        self.size = size
+        self.threshold = threshold
+        self.prefixttl = prefixttl
+        self.hits = 0
+        self.misses = 0
+        self.prefix_hits = 0
+        self._entries = OrderedDict()
+        self._flagged = OrderedDict()
+        self._prefixes = {}
+        self._lock = Lock()
+        # last time the cache file was read or written (see save)
+        self._synced = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, n):
+        """
+        Return the valid verdict of the given address or None if it's not cached.
+        """
+        now = time()
+        with self._lock:
+            verdict = self._entries.pop(n, None)
+            if verdict is not None and verdict.time_expire > now:
+                # move to the end: most recently used
+                self._entries[n] = verdict
+                self.hits += 1
+                return verdict
+
+            if self._prefixes:
+                low = prefix_network(n)[0]
+                verdict = self._prefixes.get(low)
+                if verdict is not None:
+                    if verdict.time_expire > now:
+                        self.hits += 1
+                        self.prefix_hits += 1
+                        return verdict
+                    del self._prefixes[low]
+
+            self.misses += 1
+            return None
+
+    def put(self, n, ip, detected, service=None, ttl=None):
+        """
+        Store the verdict of the given address.
+        :return: The prefix verdict if this verdict caused the prefix of the address to be flagged, None otherwise
+        """
+        now = time()
+        verdict = Verdict(ip, detected, service, now, now + (self.ttl if ttl is None else ttl))
+        with self._lock:
+            self._entries.pop(n, None)
+            self._entries[n] = verdict
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+            if detected and self.threshold:
+                return self._aggregate(n, service, now)
+        return None
+
+    def _aggregate(self, n, service, now):
+        """
+        Record a flagged address in its prefix and flag the prefix if needed (must be called holding the lock).
+        """
+        low, high = prefix_network(n)
+        seen = self._flagged.pop(low, None) or {}
+        seen[n] = now
+        # only sightings within the prefix ttl window count
+        for x in [x for x, t in seen.iteritems() if t <= now - self.prefixttl]:
+            del seen[x]
+        self._flagged[low] = seen
+        while len(self._flagged) > self.size:
+            self._flagged.popitem(last=False)
+
+        current = self._prefixes.get(low)
+        if len(seen) < self.threshold or (current is not None and current.time_expire > now):
+            return None
+
+        verdict = Verdict(format_network(low, high), True, service, now, now + self.prefixttl, prefix=True)
+        self._prefixes[low] = verdict
+        return verdict
+
+    def prefixes(self):
+        """
+        Return the list of (verdict, flagged addresses count) tuples of the currently flagged prefixes.
+        """
+        now = time()
+        with self._lock:
+            return [(v, len(self._flagged.get(low, ()))) for low, v in sorted(self._prefixes.iteritems())
+                    if v.time_expire > now]
+
+    def items(self, low=0, high=None):
+        """
+        Return the list of valid (address, verdict) tuples whose address is within the given range.
+        """
+        now = time()
+        with self._lock:
+            return [(n, v) for n, v in self._entries.iteritems()
+                    if v.time_expire > now and low <= n and (high is None or n <= high)]
+
+    def save(self, path, merge=False):
+        """
+        Write the valid address verdicts to the given file (one JSON object per line).
+        :param merge: Whether to keep the verdicts stored in the file by someone else since it was last read or
+                      written (e.g. by audit.py --populate): the most recent verdict of an address wins
+        :return: The number of verdicts written
+        """
+        now = time()
+        with self._lock:
+            verdicts = dict((n, v) for n, v in self._entries.iteritems() if v.time_expire > now)
+
+        if merge and os.path.isfile(path):
+            # older verdicts were already loaded: they are either still cached or deliberately discarded
+            for n, verdict in self._read(path):
+                if self._synced is not None and verdict.time_add < self._synced:
+                    continue
+                current = verdicts.get(n)
+                if current is None or current.time_add < verdict.time_add:
+                    verdicts[n] = verdict
+
+        # write in a temporary file and rename it so a crash never leaves a truncated file behind
+        fd, tmp = tempfile.mkstemp(prefix='%s.' % os.path.basename(path), suffix='.tmp',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for v in verdicts.itervalues():
+                    f.write('%s\n' % json.dumps({'ip': v.ip, 'detected': v.detected, 'service': v.service,
+                                                 'time_add': v.time_add, 'time_expire': v.time_expire}))
+            if os.path.exists(path) and os.name == 'nt':
+                os.remove(path)
+            os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._synced = now
+        return len(verdicts)
+
+    def load(self, path):
+        """
+        Load the verdicts written by save() from the given file: expired and invalid entries are skipped.
+        :return: The number of verdicts loaded
+        """
+        loaded = 0
+        self._synced = time()
+        for n, verdict in self._read(path):
+            with self._lock:
+                self._entries.pop(n, None)
+                self._entries[n] = verdict
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+            loaded += 1
+        return loaded
+
+    @staticmethod
+    def _read(path):
+        """
+        Iterate over the valid (address, verdict) tuples stored in the given file.
+        """
+        now = time()
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                    n = ip2long(data['ip'])
+                    verdict = Verdict(data['ip'], bool(data['detected']), data['service'],
+                                      float(data['time_add']), float(data['time_expire']))
+                except (ValueError, KeyError, TypeError):
+                    continue
+                if verdict.time_expire > now:
+                    yield n, verdict
+
+    def discard_clean(self):
+        """
+        Remove the clean verdicts from the cache (e.g. after the local proxy lists changed).
+        :return: The number of verdicts removed
+        """
+        with self._lock:
+            clean = [n for n, v in self._entries.iteritems() if not v.detected]
+            for n in clean:
+                del self._entries[n]
+        return len(clean)
+
+    def clear(self):
+        """
+        Remove all the verdicts from the cache.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._flagged.clear()
+            self._prefixes.clear()
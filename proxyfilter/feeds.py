@@ -0,0 +1,206 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+
+from bisect import bisect_right
+from bloom import iter_feed
+from iputils import parse_network
+from threading import Event
+from threading import Thread
+from time import time
+
+
+def list_feeds(directory):
+    """
+    Return the sorted list of feed files found in the given directory.
+    """
+    if not os.path.isdir(directory):
+        return []
+    paths = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.startswith('.') and not name.endswith(('.bloom', '.tmp')) and os.path.isfile(path):
+            paths.append(path)
+    return paths
+
+
+class FeedIndex(object):
+    """
+    Immutable lookup index built from a set of feed files.
+    Single addresses are stored in a hash set, networks as sorted non overlapping ranges.
+    """
+    def __init__(self, addresses=(), networks=(), files=0, invalid=0):
+        """
+        Object constructor.
+        :param addresses: Iterable of single addresses (as integers)
+        :param networks: Iterable of (low, high) integer ranges
+        :param files: The number of files the index has been built from
+        :param invalid: The number of entries which have been discarded
+        """
+        self.addresses = frozenset(addresses)
+        self.files = files
+        self.invalid = invalid
+
+        # merge overlapping ranges so a single bisect is enough to match
+        merged = []
+        for low, high in sorted(networks):
+            if merged and low <= merged[-1][1] + 1:
+                if high > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], high)
+            else:
+                merged.append((low, high))
+
+        self.lows = tuple(x[0] for x in merged)
+        self.highs = tuple(x[1] for x in merged)
+
+    def __contains__(self, n):
+        """
+        Return True if the given address (as integer) is listed in the index.
+        """
+        if n in self.addresses:
+            return True
+        i = bisect_right(self.lows, n) - 1
+        return i >= 0 and n <= self.highs[i]
+
+    def __len__(self):
+        return len(self.addresses) + len(self.lows)
+
+    @classmethod
+    def from_files(cls, paths):
+        """
+        Build a new index from the given feed files.
+        """
+        addresses = set()
+        networks = []
+        invalid = 0
+        for path in paths:
+            for entry in iter_feed(path):
+                try:
+                    low, high = parse_network(entry)
+                except ValueError:
+                    invalid += 1
+                    continue
+                if low == high:
+                    addresses.add(low)
+                else:
+                    networks.append((low, high))
+        return cls(addresses, networks, len(paths), invalid)
+
+
+class FeedManager(object):
+    """
+    Watch a directory of feed files and keep an up to date FeedIndex.
+    The first index is built upon start (scans must never run against an empty index), later ones in a
+    background thread and swapped in with a single reference assignment: readers always see either
+    the previous or the new index, never a partial one.
+    """
+    def __init__(self, plugin, directory, interval=60):
+        """
+        Object constructor.
+        :param plugin: The plugin instance
+        :param directory: The directory holding the feed files
+        :param interval: The amount of seconds between two directory checks
+        """
+        self.p = plugin
+        self.directory = directory
+        self.interval = interval
+        self.index = FeedIndex()
+        self._signature = None
+        self._stop = Event()
+        self._thread = None
+
+    def files(self):
+        """
+        Return the sorted list of feed files found in the watched directory.
+        """
+        return list_feeds(self.directory)
+
+    def reload(self, force=False):
+        """
+        Rebuild the index if any feed file changed since the last build.
+        :return: True if the index has been rebuilt, False otherwise
+        """
+        paths = self.files()
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime, stat.st_size))
+            except OSError:
+                pass
+
+        if not force and signature == self._signature:
+            return False
+
+        start = time()
+        try:
+            index = FeedIndex.from_files([x[0] for x in signature])
+        except (IOError, OSError), e:
+            self.p.error('could not rebuild feed index from %s: %s' % (self.directory, e))
+            return False
+
+        elapsed = time() - start
+        rebuild = self._signature is not None
+        self.index = index
+        self._signature = signature
+
+        # clean verdicts produced by the previous index may be wrong now: let the clients be scanned again
+        if rebuild and self.p.cache is not None:
+            self.p.debug('discarded %s cached clean verdicts after the feed index rebuild' % self.p.cache.discard_clean())
+
+        self.p.info('feed index rebuilt in %.3fs: %s addresses, %s networks from %s files (%s invalid entries)' % (
+                    elapsed, len(index.addresses), len(index.lows), index.files, index.invalid))
+        self.p.metric_set('feeds.rebuild_time', round(elapsed, 3))
+        self.p.metric_set('feeds.addresses', len(index.addresses))
+        self.p.metric_set('feeds.networks', len(index.lows))
+        self.p.metric_set('feeds.files', index.files)
+        self.p.metric_incr('feeds.rebuilds')
+        return True
+
+    def start(self):
+        """
+        Start watching the feed directory.
+        """
+        if self._thread and self._thread.isAlive() and not self._stop.isSet():
+            return
+        if self._signature is None:
+            self.reload()
+        # a thread being stopped keeps its own stop event and exits on its own
+        self._stop = Event()
+        self._thread = Thread(target=self._run, args=(self._stop,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop watching the feed directory.
+        """
+        self._stop.set()
+
+    def _run(self, stop):
+        """
+        Background thread loop.
+        :param stop: The event stopping this thread
+        """
+        while not stop.isSet():
+            try:
+                self.reload()
+            except Exception, e:
+                self.p.error('unexpected error while reloading feed index: %s' % e)
+            stop.wait(self.interval)
@@ -0,0 +1,206 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import re
+import struct
+
+# All the addresses are handled as integers in the IPv6 address space:
+# IPv4 addresses are mapped into ::ffff:0:0/96 so that both families share
+# the same ordering and can be matched against the same ranges.
+
+IPV4_MAPPED = 0xffff << 32
+IPV4_MAX = 0xffffffff
+IPV6_MAX = (1 << 128) - 1
+IPV6_GROUP = re.compile(r'^[0-9a-fA-F]{1,4}\Z')
+
+
+def _ipv4(ip):
+    """
+    Convert the given dotted quad into an integer (not mapped).
+    """
+    parts = ip.split('.')
+    if len(parts) != 4:
+        raise ValueError('invalid ipv4 address: %s' % ip)
+    n = 0
+    for part in parts:
+        if not part.isdigit() or int(part) > 255:
+            raise ValueError('invalid ipv4 address: %s' % ip)
+        n = (n << 8) | int(part)
+    return n
+
+
+def _ipv6(ip):
+    """
+    Convert the given IPv6 address into an integer.
+    """
+    if ip.count('::') > 1:
+        raise ValueError('invalid ipv6 address: %s' % ip)
+
+    def groups(text):
+        if not text:
+            return []
+        values = []
+        items = text.split(':')
+        for i, item in enumerate(items):
+            if '.' in item and i == len(items) - 1:
+                # embedded ipv4 address (e.g. ::ffff:1.2.3.4)
+                n = _ipv4(item)
+                values.extend([n >> 16, n & 0xffff])
+            else:
+                # int() alone would accept signs, whitespaces and 0x prefixes
+                if not IPV6_GROUP.match(item):
+                    raise ValueError('invalid ipv6 address: %s' % ip)
+                values.append(int(item, 16))
+        return values
+
+    if '::' in ip:
+        head, tail = ip.split('::')
+        head, tail = groups(head), groups(tail)
+        if len(head) + len(tail) > 7:
+            raise ValueError('invalid ipv6 address: %s' % ip)
+        values = head + [0] * (8 - len(head) - len(tail)) + tail
+    else:
+        values = groups(ip)
+        if len(values) != 8:
+            raise ValueError('invalid ipv6 address: %s' % ip)
+
+    n = 0
+    for value in values:
+        n = (n << 16) | value
+    return n
+
+
+def ip2long(ip):
+    """
+    Convert the given ip address (IPv4 or IPv6) into an integer of the IPv6 address space.
+    :raise ValueError: If the given string is not a valid ip address
+    """
+    ip = ip.strip().strip('[]').split('%', 1)[0]
+    if ':' in ip:
+        return _ipv6(ip)
+    return IPV4_MAPPED | _ipv4(ip)
+
+
+def long2ip(n):
+    """
+    Convert the given integer of the IPv6 address space into its textual representation.
+    """
+    if n >> 32 == 0xffff:
+        return '.'.join(str((n >> s) & 0xff) for s in (24, 16, 8, 0))
+
+    values = [(n >> (112 - 16 * i)) & 0xffff for i in xrange(8)]
+
+    # compress the longest run of zero groups
+    start, length = -1, 0
+    i = 0
+    while i < 8:
+        if values[i] == 0:
+            j = i
+            while j < 8 and values[j] == 0:
+                j += 1
+            if j - i > length and j - i > 1:
+                start, length = i, j - i
+            i = j
+        else:
+            i += 1
+
+    if start == -1:
+        return ':'.join('%x' % v for v in values)
+    head = ':'.join('%x' % v for v in values[:start])
+    tail = ':'.join('%x' % v for v in values[start + length:])
+    return '%s::%s' % (head, tail)
+
+
+def is_ipv4(n):
+    """
+    Return True if the given integer is an IPv4 mapped address.
+    """
+    return n >> 32 == 0xffff
+
+
+def parse_network(network):
+    """
+    Convert the given network (CIDR notation or single ip address) into the lowest and highest
+    integer of the IPv6 address space it covers. IPv4 prefix lengths are relative to the IPv4 address.
+    :raise ValueError: If the given string is not a valid network
+    """
+    if '/' not in network:
+        n = ip2long(network)
+        return n, n
+
+    address, bits = network.strip().split('/', 1)
+    n = ip2long(address)
+    if not bits.isdigit():
+        raise ValueError('invalid network: %s' % network)
+
+    bits = int(bits)
+    maxbits = 32 if is_ipv4(n) else 128
+    if bits > maxbits:
+        raise ValueError('invalid network: %s' % network)
+
+    hostmask = (1 << (maxbits - bits)) - 1
+    return n & ~hostmask & IPV6_MAX, n | hostmask
+
+
+def long2bytes(n):
+    """
+    Pack the given integer of the IPv6 address space into its 16 bytes big endian representation.
+    """
+    return struct.pack('!QQ', n >> 64, n & 0xffffffffffffffff)
+
+
+def bytes2long(data):
+    """
+    Unpack the given 16 bytes big endian representation into an integer of the IPv6 address space.
+    """
+    high, low = struct.unpack('!QQ', str(data))
+    return (high << 64) | low
+
+
+def prefix_network(n, bits4=24, bits6=48):
+    """
+    Return the (low, high) range of the prefix the given address belongs to.
+    :param n: The address as an integer of the IPv6 address space
+    :param bits4: The prefix length used for IPv4 addresses
+    :param bits6: The prefix length used for IPv6 addresses
+    """
+    hostmask = (1 << (32 - bits4)) - 1 if is_ipv4(n) else (1 << (128 - bits6)) - 1
+    return n & ~hostmask & IPV6_MAX, n | hostmask
+
+
+def split_families(low, high):
+    """
+    Split the given (low, high) range at the boundaries of the IPv4 mapped block.
+    :return: The list of (low, high, ipv4) tuples of the non empty parts of the range
+    """
+    parts = []
+    for start, end, ipv4 in ((0, IPV4_MAPPED - 1, False),
+                             (IPV4_MAPPED, IPV4_MAPPED | IPV4_MAX, True),
+                             ((IPV4_MAPPED | IPV4_MAX) + 1, IPV6_MAX, False)):
+        if low <= end and high >= start:
+            parts.append((max(low, start), min(high, end), ipv4))
+    return parts
+
+
+def format_network(low, high):
+    """
+    Return the CIDR notation of the given (low, high) range (which must be a valid network).
+    """
+    hostbits = (high - low + 1).bit_length() - 1
+    bits = (32 if is_ipv4(low) else 128) - hostbits
+    return '%s/%s' % (long2ip(low), bits)
@@ -17,7 +17,12 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
 
+import os
+import re
+
 from b3.exceptions import MissingRequirement
+from bloom import BloomFilter
+from iputils import ip2long
 from urllib2 import urlopen
 
 
@@ -25,6 +30,9 @@ class ProxyScanner(object):
     """
     Base class for Proxy scanners
     """
+    shadow = False
+    remote = False
+
     def __init__(self, plugin, service, url):
         """
         Object constructor.
@@ -33,12 +41,28 @@ class ProxyScanner(object):
         self.service = service
         self.url = url
 
+    @property
+    def timeout(self):
+        """
+        Return the amount of seconds this scanner may spend contacting a remote service.
+        Shadow scanners run on their own time budget so they never borrow the authoritative one.
+        """
+        return self.p.settings['shadowtimeout'] if self.shadow else self.p.settings['timeout']
+
     def scan(self, client):
         """
+        Return True if the given client is connected through a Proxy server, False otherwise.
+        The given client is usually a ScanJob exposing the id, cid, name, ip and location attributes.
         !!! Inheriting classes MUST implement this method !!!
         """
         raise NotImplementedError
 
+    def close(self):
+        """
+        Release the resources held by the scanner: called once it has been withdrawn from the registry.
+        """
+        pass
+
     ####################################################################################################################
     #                                                                                                                  #
     #   CUSTOM LOGGING METHODS                                                                                         #
@@ -75,6 +99,8 @@ class WinmxunlimitedProxyScanner(ProxyScanner):
     """
     Perform proxy detection using winmxunlimited.net API
     """
+    remote = True
+
     responses = {
         'INVALID_IP': 'Invalid IP',
         'PUBLIC_PROXY': 'Public',
@@ -89,7 +115,7 @@ class WinmxunlimitedProxyScanner(ProxyScanner):
         try:
 
             self.debug("contacting service api to check proxy connection for %s <@%s>..." % (client.name, client.id))
-            response = urlopen(url=self.url % client.ip, timeout=self.p.settings['timeout'])
+            response = urlopen(url=self.url % client.ip, timeout=self.timeout)
             data = response.read().strip()
 
             if data == self.responses['INVALID_IP']:
@@ -123,9 +149,48 @@ class WinmxunlimitedProxyScanner(ProxyScanner):
 ########################################################################################################################
 
 
+def compile_location_rules(rules):
+    """
+    Compile the given {field: [rule, ...]} dict into a list of (field, regex) tuples: the rules of each field
+    are merged into a single case insensitive alternation so a location is matched with one search per field.
+    Rules are keywords (substring match) or regular expressions when prefixed by 're:'.
+    :raise ValueError: If a regular expression is not valid
+    """
+    compiled = []
+    for field in sorted(rules):
+        patterns = []
+        for rule in rules[field]:
+            if rule.startswith('re:'):
+                try:
+                    re.compile(rule[3:])
+                except re.error, e:
+                    raise ValueError('invalid regular expression for location field %s: %s (%s)' % (field, rule[3:], e))
+                patterns.append(rule[3:])
+            else:
+                patterns.append(re.escape(rule))
+        if patterns:
+            compiled.append((field, re.compile('|'.join('(?:%s)' % x for x in patterns), re.IGNORECASE)))
+    return compiled
+
+
+def match_location(rules, location):
+    """
+    Match the given location against the given compiled rules (see compile_location_rules).
+    :return: The (field, matched text) tuple of the first matching rule or None
+    """
+    for field, regex in rules:
+        value = getattr(location, field, None)
+        if not value:
+            continue
+        m = regex.search(value if isinstance(value, basestring) else str(value))
+        if m:
+            return field, m.group(0)
+    return None
+
+
 class GeolocationPluginProxyScanner(ProxyScanner):
     """
-    Perform proxy detection using information retrieved by the GeolocationPlugin.
+    Perform proxy detection using information retrieved by the GeolocationPlugin (see the [geolocation] section).
     """
     locationPlugin = None
 
@@ -141,13 +206,135 @@ class GeolocationPluginProxyScanner(ProxyScanner):
         """
         Return True if the given client is connected through a Proxy server, False otherwise.
         """
-        if not hasattr(client, 'location') or not client.location.country:
+        location = getattr(client, 'location', None)
+        if not location:
             self.debug('could not perform proxy scan on %s <@%s> : geolocation data not available' % (client.name, client.id))
             return False
 
-        if 'proxy' in client.location.country.lower():
+        match = match_location(self.p.settings['geolocation']['compiled'], location)
+        if match:
+            self.debug('%s <@%s> detected as using a proxy: %s (%s: %s)' % (client.name, client.id, client.ip,
+                                                                            match[0], match[1]))
+            return True
+
+        self.debug('%s <@%s> doesn\'t seems to be using a proxy' % (client.name, client.id))
+        return False
+
+
+########################################################################################################################
+#                                                                                                                      #
+#   BLOOM FILTER BASED SCANNER                                                                                         #
+#                                                                                                                      #
+########################################################################################################################
+
+
+class BloomFilterProxyScanner(ProxyScanner):
+    """
+    Perform proxy detection using a Bloom filter built from a local feed of known bad ip addresses.
+    The filter is built offline (python bloom.py <feed> <filter> [errorrate]): building it from a large
+    feed takes minutes and must not hold B3.
+    """
+    bloom = None
+
+    def __init__(self, plugin, service, url):
+        """
+        Object constructor.
+        """
+        super(BloomFilterProxyScanner, self).__init__(plugin, service, url)
+        self.feed = plugin.settings['bloomfilter']['feed']
+        if not self.feed or not os.path.isfile(self.feed):
+            raise MissingRequirement('feed file not found: %s' % self.feed)
+
+        path = plugin.settings['bloomfilter']['filter'] or '%s.bloom' % self.feed
+        if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(self.feed):
+            raise MissingRequirement('bloom filter %s is missing or older than the feed: '
+                                     'build it with python bloom.py %s %s' % (path, self.feed, path))
+
+        try:
+            self.bloom = BloomFilter(path)
+        except ValueError, e:
+            raise MissingRequirement('%s: rebuild it with python bloom.py %s %s' % (e, self.feed, path))
+        self.debug('loaded bloom filter %s: %s entries, %s bits, %s hashes' % (path, len(self.bloom),
+                                                                              self.bloom.bits, self.bloom.hashes))
+
+    def scan(self, client):
+        """
+        Return True if the given client is connected through a Proxy server, False otherwise.
+        """
+        try:
+            n = ip2long(client.ip)
+        except ValueError:
+            self.warning('invalid ip address supplied to the bloom filter : <@%s:%s>' % (client.id, client.ip))
+            return False
+
+        try:
+            if n not in self.bloom:
+                self.debug('%s <@%s> doesn\'t seems to be using a proxy' % (client.name, client.id))
+                return False
+            # the bloom filter may produce false positives: confirm with an exact lookup
+            detected = self.bloom.exact(n)
+        except ValueError:
+            # the service has been turned off while scanning: the filter is closed
+            self.debug('bloom filter closed while scanning %s <@%s>' % (client.name, client.id))
+            return False
+
+        if detected:
+            self.debug('%s <@%s> detected as using a proxy: %s' % (client.name, client.id, client.ip))
+            return True
+
+        self.debug('bloom filter false positive for %s <@%s> : %s' % (client.name, client.id, client.ip))
+        return False
+
+    def close(self):
+        """
+        Release the memory mapped filter.
+        """
+        self.bloom.close()
+
+
+########################################################################################################################
+#                                                                                                                      #
+#   LOCAL FEEDS BASED SCANNER                                                                                          #
+#                                                                                                                      #
+########################################################################################################################
+
+
+class LocalFeedProxyScanner(ProxyScanner):
+    """
+    Perform proxy detection using the index of the local feed files (see FeedManager).
+    """
+    def __init__(self, plugin, service, url):
+        """
+        Object constructor.
+        """
+        if not plugin.feeds:
+            raise MissingRequirement('feeds directory is not configured')
+        super(LocalFeedProxyScanner, self).__init__(plugin, service, url)
+        # the feed directory is watched only while the service is running
+        plugin.feeds.start()
+
+    def scan(self, client):
+        """
+        Return True if the given client is connected through a Proxy server, False otherwise.
+        """
+        try:
+            n = ip2long(client.ip)
+        except ValueError:
+            self.warning('invalid ip address supplied to the feed index : <@%s:%s>' % (client.id, client.ip))
+            return False
+
+        # grab the current index once: it may be swapped by the feed manager at any time
+        index = self.p.feeds.index
+        if n in index:
             self.debug('%s <@%s> detected as using a proxy: %s' % (client.name, client.id, client.ip))
             return True
 
         self.debug('%s <@%s> doesn\'t seems to be using a proxy' % (client.name, client.id))
-        return False
\ No newline at end of file
+        return False
+
+    def close(self):
+        """
+        Stop watching the feed directory (unless a new instance of the service took over).
+        """
+        if self.service not in self.p.services and self.service not in self.p.shadows:
+            self.p.feeds.stop()
@@ -0,0 +1,18 @@
+ALTER TABLE proxies MODIFY ip VARCHAR(45) NOT NULL, ADD ip_bin BINARY(16) NULL AFTER ip, ADD KEY ip_bin (ip_bin, id), ADD KEY client_id (client_id, id);
+CREATE TABLE IF NOT EXISTS proxies_reputation (
+client_id INT(10) UNSIGNED NOT NULL,
+ip_prefix VARCHAR(49) NOT NULL,
+clean_streak INT(10) UNSIGNED NOT NULL DEFAULT 0,
+stable_streak INT(10) UNSIGNED NOT NULL DEFAULT 0,
+last_flag INT(10) UNSIGNED NOT NULL DEFAULT 0,
+time_edit INT(10) UNSIGNED NOT NULL,
+PRIMARY KEY (client_id)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8;
+CREATE TABLE IF NOT EXISTS proxies_allowlist (
+id INT(10) UNSIGNED NOT NULL AUTO_INCREMENT,
+entry VARCHAR(64) NOT NULL,
+admin_id INT(10) UNSIGNED NOT NULL DEFAULT 0,
+time_add INT(10) UNSIGNED NOT NULL,
+PRIMARY KEY (id),
+UNIQUE KEY entry (entry)
+) ENGINE=MyISAM DEFAULT CHARSET=utf8 AUTO_INCREMENT=1;
\ No newline at end of file
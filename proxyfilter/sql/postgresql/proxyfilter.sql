@@ -2,5 +2,20 @@ CREATE TABLE IF NOT EXISTS proxies (
 id SERIAL PRIMARY KEY,
 client_id INTEGER NOT NULL,
 service VARCHAR(64) NOT NULL,
-ip VARCHAR(15) NOT NULL,
+ip VARCHAR(45) NOT NULL,
+ip_bin BYTEA NULL,
+time_add INTEGER NOT NULL);
+CREATE INDEX proxies_ip_bin ON proxies (ip_bin, id);
+CREATE INDEX proxies_client_id ON proxies (client_id, id);
+CREATE TABLE IF NOT EXISTS proxies_reputation (
+client_id INTEGER NOT NULL PRIMARY KEY,
+ip_prefix VARCHAR(49) NOT NULL,
+clean_streak INTEGER NOT NULL DEFAULT 0,
+stable_streak INTEGER NOT NULL DEFAULT 0,
+last_flag INTEGER NOT NULL DEFAULT 0,
+time_edit INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS proxies_allowlist (
+id SERIAL PRIMARY KEY,
+entry VARCHAR(64) NOT NULL UNIQUE,
+admin_id INTEGER NOT NULL DEFAULT 0,
 time_add INTEGER NOT NULL);
\ No newline at end of file
@@ -0,0 +1,16 @@
+ALTER TABLE proxies ALTER COLUMN ip TYPE VARCHAR(45);
+ALTER TABLE proxies ADD COLUMN ip_bin BYTEA NULL;
+CREATE INDEX proxies_ip_bin ON proxies (ip_bin, id);
+CREATE INDEX proxies_client_id ON proxies (client_id, id);
+CREATE TABLE IF NOT EXISTS proxies_reputation (
+client_id INTEGER NOT NULL PRIMARY KEY,
+ip_prefix VARCHAR(49) NOT NULL,
+clean_streak INTEGER NOT NULL DEFAULT 0,
+stable_streak INTEGER NOT NULL DEFAULT 0,
+last_flag INTEGER NOT NULL DEFAULT 0,
+time_edit INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS proxies_allowlist (
+id SERIAL PRIMARY KEY,
+entry VARCHAR(64) NOT NULL UNIQUE,
+admin_id INTEGER NOT NULL DEFAULT 0,
+time_add INTEGER NOT NULL);
\ No newline at end of file
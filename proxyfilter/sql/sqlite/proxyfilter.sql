@@ -2,5 +2,20 @@ CREATE TABLE IF NOT EXISTS proxies (
 id INTEGER PRIMARY KEY AUTOINCREMENT,
 client_id INTEGER(10) NOT NULL,
 service VARCHAR(64) NOT NULL,
-ip VARCHAR(15) NOT NULL,
+ip VARCHAR(45) NOT NULL,
+ip_bin BLOB NULL,
+time_add INTEGER(10) NOT NULL);
+CREATE INDEX IF NOT EXISTS proxies_ip_bin ON proxies (ip_bin, id);
+CREATE INDEX IF NOT EXISTS proxies_client_id ON proxies (client_id, id);
+CREATE TABLE IF NOT EXISTS proxies_reputation (
+client_id INTEGER(10) NOT NULL PRIMARY KEY,
+ip_prefix VARCHAR(49) NOT NULL,
+clean_streak INTEGER(10) NOT NULL DEFAULT 0,
+stable_streak INTEGER(10) NOT NULL DEFAULT 0,
+last_flag INTEGER(10) NOT NULL DEFAULT 0,
+time_edit INTEGER(10) NOT NULL);
+CREATE TABLE IF NOT EXISTS proxies_allowlist (
+id INTEGER PRIMARY KEY AUTOINCREMENT,
+entry VARCHAR(64) NOT NULL UNIQUE,
+admin_id INTEGER(10) NOT NULL DEFAULT 0,
 time_add INTEGER(10) NOT NULL);
\ No newline at end of file
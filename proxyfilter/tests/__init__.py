@@ -66,7 +66,10 @@ class ProxyfilterTestCase(unittest2.TestCase):
     def setUp(self):
         # create a FakeConsole parser
         self.parser_conf = MainConfig(CfgConfigParser(allow_no_value=True))
-        self.parser_conf.loadFromString(r"""""")
+        self.parser_conf.loadFromString(r"""
+[b3]
+time_format: %I:%M%p %Z %m/%d/%y
+""")
         with logging_disabled():
             from b3.fake import FakeConsole
             self.console = FakeConsole(self.parser_conf)
@@ -86,4 +89,15 @@ class ProxyfilterTestCase(unittest2.TestCase):
         patch_proxy_filter()
 
     def tearDown(self):
-        self.console.working = False
\ No newline at end of file
+        self.stop_plugin()
+        self.console.working = False
+
+    def stop_plugin(self):
+        """
+        Stop the scan workers and the feed watcher of the plugin under test (if any).
+        """
+        p = getattr(self, 'p', None)
+        if p:
+            p.stop_workers()
+            if p.feeds:
+                p.feeds.stop()
\ No newline at end of file
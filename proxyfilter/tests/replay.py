@@ -0,0 +1,346 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+"""
+Replay the client connections recorded in game server logs (or B3 logs) against the plugin running
+on a FakeConsole, with stub proxy scanners, and report throughput, outbound calls and cache effectiveness
+for each plugin configuration file:
+
+    python -m proxyfilter.tests.replay games.log [--speed 10] [--config a.ini --config b.ini]
+                                                 [--stub winmxunlimited:0.3:0.05:remote]
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from b3.config import CfgConfigParser
+from b3.config import MainConfig
+from b3.plugins.admin import AdminPlugin
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime
+from hashlib import md5
+from proxyfilter import ProxyfilterPlugin
+from proxyfilter.proxyscanner import ProxyScanner
+from threading import Lock
+from time import sleep
+from time import time
+from . import logging_disabled
+
+PLUGIN_DIR = os.path.join(os.path.dirname(__file__), '..')
+DEFAULT_CONFIG = os.path.join(PLUGIN_DIR, 'conf', 'plugin_proxyfilter.ini')
+
+# game server log lines (e.g. "  3:12 ClientUserinfo: 2 \ip\1.2.3.4:27960\name\Foo") and B3 log lines
+# embedding them (e.g. "151019 21:04:33\tVERBOSE\t...ClientUserinfo: 2 \ip\...") are both supported
+GAME_TIME = re.compile(r'^\s*(?P<minutes>\d+):(?P<seconds>\d{2})\s')
+B3_TIME = re.compile(r'^(?P<time>\d{6} \d{2}:\d{2}:\d{2})\s')
+ACTION = re.compile(r'(?P<action>ClientUserinfo|ClientDisconnect):\s*(?P<cid>\d+)\s*(?P<data>.*)$')
+
+LogEvent = namedtuple('LogEvent', ('time', 'action', 'cid', 'ip', 'name', 'guid'))
+
+
+def parse_userinfo(data):
+    """
+    Convert the given userinfo string (\key\value\key\value...) into a dict.
+    """
+    items = data.strip().lstrip('\\').split('\\')
+    return dict(zip(items[0::2], items[1::2]))
+
+
+def parse_ip(address):
+    """
+    Strip the port from the given address (e.g. 1.2.3.4:27960 or [::1]:27960).
+    """
+    if address.startswith('['):
+        return address[1:].split(']', 1)[0]
+    if address.count(':') == 1:
+        return address.split(':', 1)[0]
+    return address
+
+
+def parse_log(path):
+    """
+    Return the list of client connections and disconnections recorded in the given log file.
+    Game server timestamps restart on server restarts: they are made monotonic.
+    """
+    events = []
+    offset = last = 0
+    with open(path, 'r') as f:
+        for line in f:
+            m = ACTION.search(line)
+            if not m:
+                continue
+
+            t = B3_TIME.match(line)
+            if t:
+                now = timegm(datetime.strptime(t.group('time'), '%y%m%d %H:%M:%S').timetuple())
+            else:
+                t = GAME_TIME.match(line)
+                if not t:
+                    continue
+                now = int(t.group('minutes')) * 60 + int(t.group('seconds')) + offset
+                if now < last:
+                    offset += last - now
+                    now = last
+            last = now
+
+            cid = m.group('cid')
+            if m.group('action') == 'ClientDisconnect':
+                events.append(LogEvent(now, 'disconnect', cid, None, None, None))
+                continue
+
+            userinfo = parse_userinfo(m.group('data'))
+            if 'ip' not in userinfo or userinfo['ip'] in ('bot', 'localhost'):
+                continue
+            events.append(LogEvent(now, 'connect', cid, parse_ip(userinfo['ip']),
+                                   re.sub(r'\^[0-9]', '', userinfo.get('name', 'player%s' % cid)),
+                                   userinfo.get('cl_guid') or userinfo.get('guid') or
+                                   md5(userinfo.get('name', '') + userinfo['ip']).hexdigest().upper()))
+
+    return sorted(events, key=lambda x: x.time)
+
+
+class StubProxyScanner(ProxyScanner):
+    """
+    Proxy scanner answering after a fixed latency: the same address always gets the same verdict.
+    """
+    def __init__(self, plugin, service, latency=0.0, rate=0.0, remote=False, shadow=False):
+        """
+        Object constructor.
+        :param latency: The amount of seconds each scan takes
+        :param rate: The fraction (0 to 1) of the addresses detected as proxies
+        """
+        super(StubProxyScanner, self).__init__(plugin, service, None)
+        self.latency = latency
+        self.rate = rate
+        self.remote = remote
+        self.shadow = shadow
+        self.calls = 0
+        self._lock = Lock()
+
+    @classmethod
+    def from_spec(cls, plugin, spec):
+        """
+        Create a stub from the given <service>:<latency>:<rate>[:remote][:shadow] specification.
+        """
+        parts = spec.split(':')
+        if len(parts) < 3:
+            raise ValueError('invalid stub specification: %s' % spec)
+        return cls(plugin, parts[0], float(parts[1]), float(parts[2]), 'remote' in parts[3:], 'shadow' in parts[3:])
+
+    def scan(self, client):
+        """
+        Return True if the given client is connected through a Proxy server, False otherwise.
+        """
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            sleep(self.latency)
+        return int(md5('%s:%s' % (self.service, client.ip)).hexdigest()[:8], 16) < self.rate * 0xffffffff
+
+
+def create_console():
+    """
+    Create a FakeConsole running the admin plugin.
+    """
+    with logging_disabled():
+        from b3.fake import FakeConsole
+        parser_conf = MainConfig(CfgConfigParser(allow_no_value=True))
+        parser_conf.loadFromString(r"""""")
+        console = FakeConsole(parser_conf)
+        # there's no B3 configuration file: resolve @conf paths against the plugin configuration directory
+        console.config.fileName = DEFAULT_CONFIG
+        admin = AdminPlugin(console, '@b3/conf/plugin_admin.ini')
+        admin._commands = {}
+        admin.onStartup()
+
+    console.getPlugin = lambda name: admin if name == 'admin' else None
+    console.config.get_external_plugins_dir = lambda: os.path.join(PLUGIN_DIR, '..')
+    console.say = lambda msg, *args: None
+    return console
+
+
+def replay(events, config, stubs, speed=0.0, drain=30):
+    """
+    Replay the given events against a new plugin instance configured with the given file.
+    :param speed: The replay speed factor (1 is real time, 0 replays as fast as possible)
+    :param drain: The maximum amount of seconds to wait for the scans to complete after the last event
+    :return: A dict of statistics
+    """
+    from b3.fake import FakeClient
+
+    console = create_console()
+    conf = CfgConfigParser()
+    conf.load(config)
+
+    plugin = ProxyfilterPlugin(console, conf)
+    plugin.onLoadConfig()
+    # there is no geolocation plugin: scan clients upon authentication
+    plugin.settings['services']['geolocationplugin']['enabled'] = False
+    plugin.onStartup()
+
+    for keyword in set(plugin.services.keys()) | set(plugin.shadows.keys()):
+        plugin.unregister_proxy_service(keyword)
+    scanners = [StubProxyScanner.from_spec(plugin, x) for x in stubs]
+    for scanner in scanners:
+        plugin.register_proxy_service(scanner.service, scanner)
+
+    clients = {}
+    joined = {}
+    kicks = []
+    stats = {'connections': 0, 'ignored': 0, 'disconnections': 0}
+
+    def kick(client, reason='', admin=None, silent=False, *args):
+        kicks.append(time() - joined.get(client.cid, time()))
+        if clients.get(client.cid) is client:
+            del clients[client.cid]
+        client.disconnect()
+
+    console.kick = kick
+
+    try:
+        start = time()
+        first = events[0].time if events else 0
+        for event in events:
+            if speed:
+                delay = (event.time - first) / speed - (time() - start)
+                if delay > 0:
+                    sleep(delay)
+
+            client = clients.get(event.cid)
+            if event.action == 'disconnect':
+                if client:
+                    del clients[event.cid]
+                    client.disconnects()
+                    stats['disconnections'] += 1
+                continue
+
+            if client and client.guid == event.guid and client.ip == event.ip:
+                # userinfo change of a connected client
+                stats['ignored'] += 1
+                continue
+            if client:
+                client.disconnects()
+
+            client = FakeClient(console=console, name=event.name, guid=event.guid, ip=event.ip, groupBits=0)
+            clients[event.cid] = client
+            joined[event.cid] = time()
+            stats['connections'] += 1
+            client.connects(event.cid)
+
+        # let the queued (and held) scans complete
+        deadline = time() + drain
+        while (plugin.queue.unfinished_tasks or plugin._pending) and time() < deadline:
+            plugin.update_load_mode()
+            sleep(.1)
+
+        stats['elapsed'] = time() - start
+        stats['kicks'] = sorted(kicks)
+        stats['scanners'] = [(x.service, x.remote, x.shadow, x.calls) for x in scanners]
+        stats['metrics'] = dict(plugin.metrics)
+        stats['pending'] = plugin.queue.unfinished_tasks + len(plugin._pending)
+    finally:
+        # don't leave the scan workers, the feed watcher and the console behind (the cache file is left untouched)
+        plugin.stop_workers()
+        if plugin.feeds:
+            plugin.feeds.stop()
+        if plugin.tracer:
+            plugin.tracer.close()
+        console.working = False
+    return stats
+
+
+def percentile(values, p):
+    """
+    Return the given percentile of the given sorted list.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def report(name, stats, out=sys.stdout):
+    """
+    Write the statistics of a replay.
+    """
+    metrics = stats['metrics']
+    hits, misses = metrics.get('cache.hits', 0), metrics.get('cache.misses', 0)
+    remote = sum(x[3] for x in stats['scanners'] if x[1] and not x[2])
+    local = sum(x[3] for x in stats['scanners'] if not x[1] and not x[2])
+    out.write('== %s ==\n' % name)
+    out.write('connections: %s (%s userinfo changes ignored, %s disconnections) in %.1fs: %.1f connections/s\n' % (
+              stats['connections'], stats['ignored'], stats['disconnections'], stats['elapsed'],
+              stats['connections'] / max(stats['elapsed'], 0.001)))
+    out.write('outbound calls: %s, local calls: %s (%s)\n' % (remote, local, ', '.join(
+              '%s%s: %s' % (x[0], ' [shadow]' if x[2] else '', x[3]) for x in stats['scanners'])))
+    out.write('cache: %s hits (%s prefix), %s misses, %.1f%% hit rate\n' % (
+              hits, metrics.get('cache.prefix_hits', 0), misses, 100.0 * hits / max(hits + misses, 1)))
+    out.write('kicks: %s, time to kick: %.3fs median, %.3fs p95\n' % (
+              len(stats['kicks']), percentile(stats['kicks'], 50), percentile(stats['kicks'], 95)))
+    out.write('load: %s local-only scans, %s cache-only scans, %s skipped, %s cancelled, %s trusted, %s still pending\n' % (
+              metrics.get('load.scans.local', 0), metrics.get('load.scans.cache', 0), metrics.get('load.skipped', 0),
+              metrics.get('jobs.cancelled', 0), metrics.get('reputation.trusted', 0), stats['pending']))
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+    """
+    parser = argparse.ArgumentParser(description='replay client connections recorded in game server or B3 logs')
+    parser.add_argument('log', nargs='+', help='the log files to replay')
+    parser.add_argument('--config', action='append', help='plugin configuration file to replay against '
+                                                          '(repeat to compare configurations) [default: %s]' % DEFAULT_CONFIG)
+    parser.add_argument('--stub', action='append', help='stub proxy scanner: <service>:<latency>:<rate>[:remote][:shadow] '
+                                                        '(repeatable) [default: winmxunlimited:0.3:0.05:remote]')
+    parser.add_argument('--speed', type=float, default=0.0, help='replay speed factor: 1 is real time, '
+                                                                 '0 replays as fast as possible [default: %(default)s]')
+    parser.add_argument('--verbose', action='store_true', help='do not silence the B3 and FakeConsole output')
+    args = parser.parse_args(argv)
+
+    events = []
+    for path in args.log:
+        events.extend(parse_log(path))
+    events.sort(key=lambda x: x.time)
+    if not events:
+        sys.stderr.write('no client connection found in %s\n' % ', '.join(args.log))
+        return 1
+
+    stubs = args.stub or ['winmxunlimited:0.3:0.05:remote']
+    results = []
+    for config in args.config or [DEFAULT_CONFIG]:
+        if args.verbose:
+            results.append((config, replay(events, config, stubs, args.speed)))
+            continue
+        # FakeConsole and FakeClient print every action: keep the report readable
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            with logging_disabled():
+                results.append((config, replay(events, config, stubs, args.speed)))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    for config, stats in results:
+        report(config, stats)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,10 +18,11 @@
 
 from b3.config import CfgConfigParser
 from mock import Mock
-from mockito import when
+from time import sleep
 from textwrap import dedent
 from proxyfilter import ProxyfilterPlugin
 from proxyfilter import WinmxunlimitedProxyScanner
+from proxyfilter.iputils import ip2long
 from . import ProxyfilterTestCase
 from . import logging_disabled
 
@@ -62,6 +63,9 @@ class Test_commands(ProxyfilterTestCase):
                 proxylist: senioradmin
                 proxyservice: senioradmin
                 proxystats: senioradmin
+                proxylookup: senioradmin
+                proxyprefixes: senioradmin
+                proxyallow: senioradmin
             """))
 
         self.p.services = {} ## DO NOT REMOVE THIS!!!!!!
@@ -82,7 +86,7 @@ class Test_commands(ProxyfilterTestCase):
         self.mike.clearMessageHistory()
         self.mike.says("!proxylist")
         # THEN
-        self.assertListEqual(['Proxy services: geolocationplugin, winmxunlimited'], self.mike.message_history)
+        self.assertListEqual(['Proxy services: bloomfilter, geolocationplugin, localfeed, winmxunlimited'], self.mike.message_history)
 
     ####################################################################################################################
     #                                                                                                                  #
@@ -245,11 +249,248 @@ class Test_commands(ProxyfilterTestCase):
         """))
         self.bill.kick = Mock()
         # WHEN
-        when(self.p.services['winmxunlimited']).scan(self.bill).thenReturn(True)
+        self.p.services['winmxunlimited'].scan = Mock(side_effect=lambda job: job.id == self.bill.id)
         self.mike.connects("1")
         self.bill.connects("2")
+        sleep(.5)
         self.mike.clearMessageHistory()
         self.mike.says("!proxystats")
         # THEN
         self.assertListEqual(['[1] proxy detected till now',
-                              '[1] : winmxunlimited'], self.mike.message_history)
\ No newline at end of file
+                              '[1] : winmxunlimited'], self.mike.message_history)
+
+    def test_cmd_proxystats_network(self):
+        # GIVEN
+        self.init(dedent(r"""
+            [settings]
+            maxlevel: reg
+            reason: ^1proxy detected
+            timeout: 4
+
+            [services]
+            winmxunlimited: yes
+            geolocationplugin: no
+
+            [messages]
+            client_rejected: ^7$client has been ^1rejected^7: proxy detected
+            proxy_list: ^7Proxy services: $services
+            stats_count_proxies: ^7[^4$count^7] ^7proxy detected till now
+            stats_detail_pattern: ^7[^4$count^7] ^7: ^3$service
+            stats_network_proxies: ^7[^4$count^7] ^7proxy detected in ^3$network
+            stats_prefix_pattern: ^7[^4$count^7] ^7: ^3$prefix
+
+            [commands]
+            proxylist: senioradmin
+            proxyservice: senioradmin
+            proxystats: senioradmin
+        """))
+        self.bill.kick = Mock()
+        # WHEN
+        self.p.services['winmxunlimited'].scan = Mock(side_effect=lambda job: job.id == self.bill.id)
+        self.mike.connects("1")
+        self.bill.connects("2")
+        sleep(.5)
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxystats 127.0.0.0/16")
+        self.mike.says("!proxystats 10.0.0.0/8")
+        self.mike.says("!proxystats 10.0.0.0/40")
+        # THEN
+        self.assertListEqual(['[1] proxy detected in 127.0.0.0/16',
+                              '[1] : 127.0.0.0/24',
+                              '[0] proxy detected in 10.0.0.0/8',
+                              'invalid network specified, try !help proxystats'], self.mike.message_history)
+
+    def test_cmd_proxystats_network_ipv6(self):
+        # GIVEN
+        self.init()
+        for i, ip in enumerate(['2001:db8:1::5', '2001:DB8:1:0::6', '2001:db8:2::1', '10.0.0.1']):
+            self.p.log_proxy_connection('winmxunlimited', Mock(id=i + 1, name='client%s' % i, ip=ip))
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxystats 2001:db8:0::/32")
+        self.mike.says("!proxystats 10.0.0.0/8")
+        # THEN
+        self.assertListEqual(['[3] proxy detected in 2001:db8::/32',
+                              '[2] : 2001:db8:1::/48',
+                              '[1] : 2001:db8:2::/48',
+                              '[1] proxy detected in 10.0.0.0/8',
+                              '[1] : 10.0.0.0/24'], self.mike.message_history)
+
+    def test_cmd_proxystats_network_mixed_families(self):
+        # GIVEN
+        self.init()
+        for i, ip in enumerate(['10.0.0.1', '10.0.0.2', '10.0.1.1', '2001:db8::1', '::1', '::1:0:0:0']):
+            self.p.log_proxy_connection('winmxunlimited', Mock(id=i + 1, name='client%s' % i, ip=ip))
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxystats ::/0")
+        # THEN
+        self.assertListEqual(['[6] proxy detected in ::/0',
+                              '[2] : 10.0.0.0/24',
+                              # ::/48 lies on both sides of the IPv4 mapped block
+                              '[2] : ::/48',
+                              '[1] : 10.0.1.0/24',
+                              '[1] : 2001:db8::/48'], self.mike.message_history)
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #  TEST CMD PROXYLOOKUP                                                                                            #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def test_cmd_proxylookup_missing_data(self):
+        # GIVEN
+        self.init()
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxylookup")
+        # THEN
+        self.assertListEqual(['missing data, try !help proxylookup'], self.mike.message_history)
+
+    def test_cmd_proxylookup_no_results(self):
+        # GIVEN
+        self.init()
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxylookup @99")
+        # THEN
+        self.assertListEqual(['No proxy detection found for @99'], self.mike.message_history)
+
+    def test_cmd_proxylookup_pagination(self):
+        # GIVEN
+        self.init()
+        self.p.settings['lookuplimit'] = 2
+        for i in range(3):
+            self.p.console.storage.query(self.p.sql['q1'] % (5, 'winmxunlimited', '10.0.0.%s' % i,
+                                                            self.p.sql_ip('10.0.0.%s' % i), 0))
+        self.p.cache.put(ip2long('10.0.0.1'), '10.0.0.1', True, 'winmxunlimited')
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxylookup 10.0.0.1")
+        # THEN
+        self.assertEqual('Cached verdict for 10.0.0.1: proxy (winmxunlimited)', self.mike.message_history[0])
+        self.assertEqual(2, len(self.mike.message_history))
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxylookup 10.0.0.0/24")
+        # THEN
+        self.assertEqual(4, len(self.mike.message_history))
+        self.assertEqual('[1] cached proxy verdicts in 10.0.0.0/24', self.mike.message_history[0])
+        self.assertEqual('More results available, type !proxylookup next', self.mike.message_history[3])
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxylookup next")
+        # THEN
+        self.assertEqual(1, len(self.mike.message_history))
+        self.assertTrue(self.mike.message_history[0].startswith('#3 10.0.0.2 @5 [winmxunlimited]'))
+
+    def test_cmd_proxylookup_next_after_disconnect(self):
+        # GIVEN
+        self.init()
+        self.p.settings['lookuplimit'] = 1
+        for i in range(2):
+            self.p.console.storage.query(self.p.sql['q1'] % (5, 'winmxunlimited', '10.0.0.%s' % i,
+                                                            self.p.sql_ip('10.0.0.%s' % i), 0))
+        self.mike.connects("1")
+        self.mike.says("!proxylookup @5")
+        # WHEN
+        self.mike.disconnects()
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxylookup next")
+        # THEN
+        self.assertListEqual(['no lookup in progress, try !help proxylookup'], self.mike.message_history)
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #  TEST CMD PROXYPREFIXES                                                                                          #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def test_cmd_proxyprefixes_empty(self):
+        # GIVEN
+        self.init()
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxyprefixes")
+        # THEN
+        self.assertListEqual(['No network has been flagged till now'], self.mike.message_history)
+
+    def test_cmd_proxyprefixes(self):
+        # GIVEN
+        self.init()
+        for i in range(1, self.p.cache.threshold + 1):
+            self.p.cache.put(ip2long('10.0.0.%s' % i), '10.0.0.%s' % i, True, 'winmxunlimited')
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxyprefixes")
+        # THEN
+        self.assertEqual(1, len(self.mike.message_history))
+        self.assertTrue(self.mike.message_history[0].startswith('10.0.0.0/24: %s proxies [winmxunlimited]' % self.p.cache.threshold))
+        self.assertTrue(self.p.cache.get(ip2long('10.0.0.200')).detected)
+        self.assertIsNone(self.p.cache.get(ip2long('10.0.1.1')))
+
+    ####################################################################################################################
+    #                                                                                                                  #
+    #  TEST CMD PROXYALLOW                                                                                             #
+    #                                                                                                                  #
+    ####################################################################################################################
+
+    def test_cmd_proxyallow_invalid_data(self):
+        # GIVEN
+        self.init()
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxyallow add")
+        self.mike.says("!proxyallow add 10.0.0.1/33")
+        # THEN
+        self.assertListEqual(['invalid data, try !help proxyallow',
+                              'invalid ip address, network or guid specified, try !help proxyallow'],
+                             self.mike.message_history)
+
+    def test_cmd_proxyallow_add(self):
+        # GIVEN
+        self.init()
+        # WHEN
+        self.mike.connects("1")
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxyallow add 10.0.0.1/24")
+        self.mike.says("!proxyallow add billguid")
+        self.mike.says("!proxyallow add 10.0.0.0/24")
+        self.mike.says("!proxyallow list")
+        # THEN
+        self.assertListEqual(['10.0.0.0/24 has been added to the allowlist',
+                              'BILLGUID has been added to the allowlist',
+                              '10.0.0.0/24 is already in the allowlist',
+                              'Proxy allowlist: 10.0.0.0/24, BILLGUID'], self.mike.message_history)
+        self.assertTrue(self.p.allowlist.match('10.0.0.200'))
+        self.assertTrue(self.p.allowlist.match('127.0.0.2', 'billguid'))
+        # entries are persisted
+        self.p.allowlist = None
+        self.p.load_allowlist()
+        self.assertEqual(2, len(self.p.allowlist))
+
+    def test_cmd_proxyallow_del(self):
+        # GIVEN
+        self.init()
+        self.mike.connects("1")
+        self.mike.says("!proxyallow add 10.0.0.1")
+        # WHEN
+        self.mike.clearMessageHistory()
+        self.mike.says("!proxyallow del 10.0.0.1")
+        self.mike.says("!proxyallow del 10.0.0.1")
+        self.mike.says("!proxyallow list")
+        # THEN
+        self.assertListEqual(['10.0.0.1 has been removed from the allowlist',
+                              '10.0.0.1 is not in the allowlist',
+                              'The proxy allowlist is empty'], self.mike.message_history)
+        self.p.load_allowlist()
+        self.assertEqual(0, len(self.p.allowlist))
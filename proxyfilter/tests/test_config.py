@@ -16,11 +16,21 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import os
+import shutil
+import tempfile
+
 from b3.config import CfgConfigParser
+from mock import Mock
 from textwrap import dedent
 from . import ProxyfilterTestCase
 from proxyfilter import ProxyfilterPlugin
 from proxyfilter import WinmxunlimitedProxyScanner
+from proxyfilter.bloom import BloomFilter
+from proxyfilter.iputils import ip2long
+from proxyfilter.proxyscanner import BloomFilterProxyScanner
+from proxyfilter.proxyscanner import LocalFeedProxyScanner
+from proxyfilter.proxyscanner import match_location
 
 
 class Test_config(ProxyfilterTestCase):
@@ -29,6 +39,8 @@ class Test_config(ProxyfilterTestCase):
         ProxyfilterTestCase.setUp(self)
 
     def init(self, config_content=None):
+        # a test may init the plugin several times: don't leave the previous instance running
+        self.stop_plugin()
         self.conf = CfgConfigParser()
         self.p = ProxyfilterPlugin(self.console, self.conf)
         if config_content:
@@ -88,11 +100,228 @@ class Test_config(ProxyfilterTestCase):
         """))
         # THEN
         self.assertDictEqual({}, self.p.services)
-        self.assertListEqual(['geolocationplugin', 'winmxunlimited'], self.p.settings['services'].keys())
+        self.assertListEqual(['bloomfilter', 'geolocationplugin', 'localfeed', 'winmxunlimited'], sorted(self.p.settings['services'].keys()))
 
     def test_config_service_enabled(self):
         # WHEN
         self.init()
         # THEN
         self.assertEqual(True, 'winmxunlimited' in self.p.services.keys())
-        self.assertIsInstance(self.p.services['winmxunlimited'], WinmxunlimitedProxyScanner)
\ No newline at end of file
+        self.assertIsInstance(self.p.services['winmxunlimited'], WinmxunlimitedProxyScanner)
+
+    def test_config_service_shadow(self):
+        # WHEN
+        self.init(dedent(r"""
+            [settings]
+            maxlevel: reg
+            reason: ^1proxy detected
+            timeout: 4
+            shadowtimeout: 10
+
+            [services]
+            winmxunlimited: shadow
+
+            [messages]
+            client_rejected: ^7$client has been ^1rejected^7: proxy detected
+            proxy_list: ^7Proxy services: $services
+            stats_count_proxies: ^7[^4$count^7] ^7proxy detected till now
+            stats_detail_pattern: ^7[^4$count^7] ^7: ^3$service
+
+            [commands]
+            proxylist: senioradmin
+            proxyservice: senioradmin
+            proxystats: senioradmin
+        """))
+        # THEN
+        self.assertEqual(10, self.p.settings['shadowtimeout'])
+        self.assertEqual(False, 'winmxunlimited' in self.p.services.keys())
+        self.assertIsInstance(self.p.shadows['winmxunlimited'], WinmxunlimitedProxyScanner)
+        self.assertEqual(10, self.p.shadows['winmxunlimited'].timeout)
+
+    def test_config_service_bloomfilter(self):
+        # GIVEN
+        fd, feed = tempfile.mkstemp(suffix='.txt')
+        os.write(fd, '# known bad addresses\n10.0.0.1\n10.0.0.2\n2001:DB8::1\n203.0.113.0/24\n10.0.0.1\n')
+        os.close(fd)
+        self.addCleanup(os.remove, feed)
+        self.addCleanup(lambda: os.path.exists(feed + '.bloom') and os.remove(feed + '.bloom'))
+        config = dedent(r"""
+            [settings]
+            maxlevel: reg
+            reason: ^1proxy detected
+            timeout: 4
+
+            [services]
+            winmxunlimited: no
+            bloomfilter: yes
+
+            [bloomfilter]
+            feed: %s
+
+            [messages]
+            client_rejected: ^7$client has been ^1rejected^7: proxy detected
+            proxy_list: ^7Proxy services: $services
+            stats_count_proxies: ^7[^4$count^7] ^7proxy detected till now
+            stats_detail_pattern: ^7[^4$count^7] ^7: ^3$service
+
+            [commands]
+            proxylist: senioradmin
+            proxyservice: senioradmin
+            proxystats: senioradmin
+        """ % feed)
+        # WHEN
+        self.init(config)
+        # THEN
+        self.assertNotIn('bloomfilter', self.p.services)
+        # WHEN
+        self.assertTupleEqual((3, 1), BloomFilter.build(feed, feed + '.bloom', 0.01, chunk=2))
+        self.init(config)
+        # THEN
+        self.assertIsInstance(self.p.services['bloomfilter'], BloomFilterProxyScanner)
+        self.assertEqual(3, len(self.p.services['bloomfilter'].bloom))
+        self.assertTrue(self.p.services['bloomfilter'].scan(Mock(id=1, ip='10.0.0.1')))
+        self.assertTrue(self.p.services['bloomfilter'].scan(Mock(id=1, ip='2001:db8:0::1')))
+        self.assertFalse(self.p.services['bloomfilter'].scan(Mock(id=1, ip='10.0.0.3')))
+        self.assertFalse(self.p.services['bloomfilter'].scan(Mock(id=1, ip='203.0.113.1')))
+        # WHEN
+        scanner = self.p.services['bloomfilter']
+        self.assertTrue(self.p.unregister_proxy_service('bloomfilter'))
+        # THEN
+        self.assertTrue(scanner.bloom._file.closed)
+        self.assertFalse(scanner.scan(Mock(id=1, ip='10.0.0.1')))
+
+    def test_config_service_localfeed(self):
+        # GIVEN
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'proxies.txt'), 'w') as f:
+            f.write('10.0.0.1\n203.0.113.0/24 # known vpn range\n')
+        # WHEN
+        self.init(dedent(r"""
+            [settings]
+            maxlevel: reg
+            reason: ^1proxy detected
+            timeout: 4
+
+            [services]
+            winmxunlimited: no
+            localfeed: yes
+
+            [feeds]
+            directory: %s
+            interval: 3600
+
+            [messages]
+            client_rejected: ^7$client has been ^1rejected^7: proxy detected
+            proxy_list: ^7Proxy services: $services
+            stats_count_proxies: ^7[^4$count^7] ^7proxy detected till now
+            stats_detail_pattern: ^7[^4$count^7] ^7: ^3$service
+
+            [commands]
+            proxylist: senioradmin
+            proxyservice: senioradmin
+            proxystats: senioradmin
+        """ % directory))
+        self.p.feeds.stop()
+        # THEN
+        self.assertEqual(3600, self.p.settings['feeds']['interval'])
+        self.assertIsInstance(self.p.services['localfeed'], LocalFeedProxyScanner)
+        self.assertEqual(1, self.p.metrics['feeds.addresses'])
+        self.assertEqual(1, self.p.metrics['feeds.networks'])
+        self.assertTrue(self.p.services['localfeed'].scan(Mock(id=1, ip='10.0.0.1')))
+        self.assertTrue(self.p.services['localfeed'].scan(Mock(id=1, ip='203.0.113.42')))
+        self.assertFalse(self.p.services['localfeed'].scan(Mock(id=1, ip='10.0.0.2')))
+        # WHEN
+        self.p.cache.put(ip2long('10.0.0.2'), '10.0.0.2', False)
+        with open(os.path.join(directory, 'more.txt'), 'w') as f:
+            f.write('10.0.0.2\n')
+        # THEN
+        self.assertTrue(self.p.feeds.reload())
+        self.assertIsNone(self.p.cache.get(ip2long('10.0.0.2')))
+        self.assertTrue(self.p.services['localfeed'].scan(Mock(id=1, ip='10.0.0.2')))
+        self.assertFalse(self.p.feeds.reload())
+
+    def test_config_service_localfeed_watcher(self):
+        # GIVEN
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, 'proxies.txt'), 'w') as f:
+            f.write('10.0.0.1\n')
+        # WHEN
+        self.init(dedent(r"""
+            [settings]
+            maxlevel: reg
+
+            [services]
+            winmxunlimited: no
+            localfeed: no
+
+            [feeds]
+            directory: %s
+        """ % directory))
+        # THEN
+        self.assertIsNone(self.p.feeds._thread)
+        # WHEN
+        self.assertTrue(self.p.init_proxy_service('localfeed'))
+        watcher = self.p.feeds._thread
+        self.assertTrue(watcher.isAlive())
+        # the service is turned off and on again while the previous watcher is still winding down
+        self.assertTrue(self.p.unregister_proxy_service('localfeed'))
+        self.assertTrue(self.p.init_proxy_service('localfeed'))
+        # THEN
+        self.assertIsNot(watcher, self.p.feeds._thread)
+        self.assertTrue(self.p.feeds._thread.isAlive())
+        watcher.join(1)
+        self.assertFalse(watcher.isAlive())
+        self.assertTrue(self.p.feeds._thread.isAlive())
+        # WHEN
+        self.p.init_proxy_service('localfeed')
+        # THEN
+        self.assertTrue(self.p.feeds._thread.isAlive())
+
+    def test_config_cachefile(self):
+        # GIVEN
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'verdicts.jsonl')
+        config = dedent(r"""
+            [settings]
+            maxlevel: reg
+            cachefile: %s
+
+            [services]
+            winmxunlimited: yes
+        """ % path)
+        self.init(config)
+        self.p.cache.put(ip2long('10.0.0.1'), '10.0.0.1', True, 'winmxunlimited')
+        # WHEN
+        self.p.onDisable()
+        self.init(config)
+        # THEN
+        self.assertEqual(path, self.p.settings['cachefile'])
+        self.assertEqual('winmxunlimited', self.p.cache.get(ip2long('10.0.0.1')).service)
+
+    def test_config_geolocation_rules(self):
+        # GIVEN
+        # WHEN
+        self.init(dedent(r"""
+            [settings]
+            maxlevel: reg
+
+            [services]
+            winmxunlimited: yes
+
+            [geolocation]
+            country: proxy
+            isp: ovh, hetzner
+                re:\bhost(ing)?\b
+        """))
+        # THEN
+        self.assertDictEqual({'country': ['proxy'], 'isp': ['ovh', 'hetzner', r're:\bhost(ing)?\b']},
+                             self.p.settings['geolocation']['rules'])
+        rules = self.p.settings['geolocation']['compiled']
+        self.assertEqual(2, len(rules))
+        self.assertEqual(('country', 'Proxy'), match_location(rules, Mock(country='Anonymous Proxy', isp=None)))
+        self.assertEqual(('isp', 'OVH'), match_location(rules, Mock(country='France', isp='OVH SAS')))
+        self.assertEqual(('isp', 'Hosting'), match_location(rules, Mock(country='Germany', isp='Foo Hosting Ltd')))
+        self.assertIsNone(match_location(rules, Mock(country='Italy', isp='Telecom Italia')))
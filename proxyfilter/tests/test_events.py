@@ -16,14 +16,24 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 
+import json
+import os
+import tempfile
+
 from b3.config import CfgConfigParser
 from mock import Mock
 from mock import call
+from mockito import any as anything
+from mockito import verify
 from mockito import when
 from textwrap import dedent
 from . import ProxyfilterTestCase
 from . import logging_disabled
 from proxyfilter import ProxyfilterPlugin
+from proxyfilter import ScanJob
+from proxyfilter.iputils import ip2long
+from proxyfilter.tracing import Tracer
+from threading import currentThread
 from time import sleep
 
 
@@ -67,6 +77,19 @@ class Test_events(ProxyfilterTestCase):
         self.mike = FakeClient(console=self.console, name="Mike", guid="mikeguid", ip="127.0.0.1", groupBits=1)
         self.bill = FakeClient(console=self.console, name="Bill", guid="billguid", ip="127.0.0.2", groupBits=2)
 
+    def start_tracing(self):
+        # trace every proxy scan in a temporary file
+        fd, path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        self.p.tracer = Tracer(path)
+        self.addCleanup(self.p.tracer.close)
+        return path
+
+    def read_traces(self, path):
+        with open(path) as f:
+            return [json.loads(line) for line in f]
+
     ####################################################################################################################
     ##                                                                                                                ##
     ##  TEST EVENT CLIENT CONNECT                                                                                     ##
@@ -77,7 +100,7 @@ class Test_events(ProxyfilterTestCase):
         # GIVEN
         self.mike.kick = Mock()
         # WHEN
-        when(self.p.services['winmxunlimited']).scan(self.mike).thenReturn(True)
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
         self.mike.connects("1")
         sleep(.5)
         # THEN
@@ -88,13 +111,204 @@ class Test_events(ProxyfilterTestCase):
         # GIVEN
         self.p.debug = Mock()
         # WHEN
-        when(self.p.services['winmxunlimited']).scan(self.mike).thenReturn(False)
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
         self.mike.connects("1")
         sleep(.5)
         # THEN
         self.p.debug.assert_has_calls(call('proxy scan completed for Mike <@1> : no proxy detected'))
         self.assertEqual(0, self.p.console.storage.query(self.p.sql['q2']).getRow()['total'])
 
+    def test_event_client_connect_cached_verdict(self):
+        # GIVEN
+        self.mike.kick = Mock()
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.mike.connects("1")
+        sleep(.5)
+        self.mike.disconnects()
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        verify(self.p.services['winmxunlimited'], times=1).scan(anything())
+        self.assertEqual(2, self.mike.kick.call_count)
+        self.assertEqual(1, self.p.metrics['cache.hits'])
+        self.assertEqual(1, self.p.metrics['cache.misses'])
+
+    def test_event_client_connect_service_disabled_during_scan(self):
+        # GIVEN
+        self.p.debug = Mock()
+        def scan(client):
+            # an admin turns the service off while the scan is in progress
+            self.p.unregister_proxy_service('winmxunlimited')
+            return False
+        self.p.services['winmxunlimited'].scan = scan
+        # WHEN
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        self.p.debug.assert_has_calls(call('proxy scan completed for Mike <@1> : no proxy detected'))
+        self.assertDictEqual({}, self.p.services)
+
+    def test_event_client_connect_held_pending_in_cache_mode(self):
+        # GIVEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
+        self.mike.connects("1")
+        sleep(.5)
+        self.p.cache.clear()
+        self.mike.kick = Mock()
+        self.p.load_mode = 'cache'
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.p.cache_proxy_scan(ScanJob(self.mike, self.p._sessions[self.mike.cid].token))
+        # THEN
+        self.assertFalse(self.mike.kick.called)
+        self.assertIn(self.mike.cid, self.p._pending)
+        # WHEN
+        self.assertEqual('normal', self.p.update_load_mode())
+        sleep(.5)
+        # THEN
+        self.mike.kick.assert_has_calls(call(reason='^1proxy detected', silent=True))
+        self.assertDictEqual({}, self.p._pending)
+        self.assertEqual(1, self.p.metrics['load.transitions.normal'])
+
+    def test_event_client_connect_local_mode(self):
+        # GIVEN
+        threads = []
+        local = Mock(remote=False, shadow=False)
+        local.scan = Mock(side_effect=lambda job: threads.append(currentThread().getName()))
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.p.services = dict(self.p.services, localstub=local)
+        self.p.record_latency(self.p.settings['latencyhigh'] * 2)
+        # WHEN
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        verify(self.p.services['winmxunlimited'], times=0).scan(anything())
+        self.assertEqual(1, len(threads))
+        self.assertTrue(threads[0].startswith('proxyfilter-worker-'))
+        self.assertEqual('clean', self.p._sessions[self.mike.cid].state)
+        self.assertEqual(1, self.p.metrics['load.scans.local'])
+
+    def test_event_client_connect_local_mode_error(self):
+        # GIVEN
+        local = Mock(remote=False, shadow=False)
+        local.scan = Mock(side_effect=IOError('feed not available'))
+        self.p.services = {'localstub': local}
+        self.p.record_latency(self.p.settings['latencyhigh'] * 2)
+        # WHEN
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        self.assertIsNone(self.p._sessions[self.mike.cid].state)
+
+    def test_plugin_disabled_stops_workers(self):
+        # GIVEN
+        workers = list(self.p._workers)
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
+        self.mike.connects("1")
+        sleep(.5)
+        self.p.cache.clear()
+        self.p.load_mode = 'cache'
+        self.p.cache_proxy_scan(ScanJob(self.mike, self.p._sessions[self.mike.cid].token))
+        # WHEN
+        self.p.onDisable()
+        # THEN
+        self.assertFalse([x for x in workers if x.isAlive()])
+        self.assertListEqual([], self.p._workers)
+        self.assertDictEqual({}, self.p._pending)
+        self.assertIsNone(self.p._sessions[self.mike.cid].state)
+        # WHEN
+        self.p.onEnable()
+        # THEN
+        self.assertEqual(self.p.settings['workers'], len([x for x in self.p._workers if x.isAlive()]))
+
+    def test_event_client_disconnect_cancels_scan(self):
+        # GIVEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
+        self.mike.connects("1")
+        sleep(.5)
+        job = ScanJob(self.mike, self.p._sessions[self.mike.cid].token)
+        self.mike.kick = Mock()
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.mike.disconnects()
+        self.p.queue_proxy_scan(job)
+        sleep(.5)
+        # THEN
+        self.assertTrue(self.p.is_cancelled(job))
+        self.assertFalse(self.mike.kick.called)
+        self.assertEqual(1, self.p.metrics['jobs.cancelled'])
+
+    def test_event_client_scanned_once_per_session(self):
+        # GIVEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
+        # WHEN
+        self.mike.connects("1")
+        sleep(.5)
+        self.p.doProxyScan(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.p.doProxyScan(self.console.getEvent('EVT_CLIENT_GEOLOCATION_FAILURE', client=self.mike))
+        sleep(.5)
+        # THEN
+        verify(self.p.services['winmxunlimited'], times=1).scan(anything())
+        self.assertEqual('clean', self.p._sessions[self.mike.cid].state)
+
+    def test_event_client_rescanned_on_ip_change(self):
+        # GIVEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
+        self.mike.connects("1")
+        sleep(.5)
+        # WHEN
+        self.mike.ip = '127.0.0.3'
+        self.p.doProxyScan(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        self.p.doProxyScan(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        sleep(.5)
+        # THEN
+        verify(self.p.services['winmxunlimited'], times=2).scan(anything())
+        self.assertEqual('127.0.0.3', self.p._sessions[self.mike.cid].ip)
+
+    def test_event_client_connect_trusted_client(self):
+        # GIVEN
+        self.p.console.storage.query(self.p.sql['q12'] % (1, '127.0.0.0/24', 50, 20, 0, 0))
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        verify(self.p.services['winmxunlimited'], times=0).scan(anything())
+        self.assertEqual(1, self.p.metrics['reputation.trusted'])
+        # a local only scan doesn't extend the clean streak
+        self.assertEqual(50, self.p.console.storage.query(self.p.sql['q11'] % 1).getRow()['clean_streak'])
+
+    def test_event_client_connect_reputation_reset(self):
+        # GIVEN
+        self.p.console.storage.query(self.p.sql['q12'] % (1, '10.0.0.0/24', 10, 10, 0, 0))
+        self.mike.kick = Mock()
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        reputation = self.p.console.storage.query(self.p.sql['q11'] % 1).getRow()
+        self.assertEqual(0, reputation['clean_streak'])
+        self.assertEqual(1, reputation['stable_streak'])
+        self.assertEqual('127.0.0.0/24', reputation['ip_prefix'])
+        self.assertNotEqual(0, reputation['last_flag'])
+
+    def test_event_client_connect_reputation_reset_cached(self):
+        # GIVEN
+        self.p.console.storage.query(self.p.sql['q12'] % (1, '127.0.0.0/24', 50, 20, 0, 0))
+        self.p.cache.put(ip2long('127.0.0.1'), '127.0.0.1', True, 'winmxunlimited')
+        self.mike.kick = Mock()
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        verify(self.p.services['winmxunlimited'], times=0).scan(anything())
+        reputation = self.p.console.storage.query(self.p.sql['q11'] % 1).getRow()
+        self.assertEqual(0, reputation['clean_streak'])
+        self.assertNotEqual(0, reputation['last_flag'])
+
     def test_event_client_connect_proxy_bypass(self):
         # GIVEN
         self.p.debug = Mock()
@@ -105,6 +319,68 @@ class Test_events(ProxyfilterTestCase):
         self.p.debug.assert_has_calls(call('bypassing proxy scan for Bill <@1> : he is a high group level player'))
         self.assertEqual(0, self.p.console.storage.query(self.p.sql['q2']).getRow()['total'])
 
+    def test_event_client_connect_shadow_proxy_detected(self):
+        # GIVEN
+        self.mike.kick = Mock()
+        self.p.shadows = {'winmxunlimited': self.p.services['winmxunlimited']}
+        self.p.services = {}
+        # WHEN
+        when(self.p.shadows['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        self.assertFalse(self.mike.kick.called)
+        self.assertEqual(0, self.p.console.storage.query(self.p.sql['q2']).getRow()['total'])
+        self.assertEqual(1, self.p.shadow_stats['winmxunlimited']['scans'])
+        self.assertEqual(1, self.p.shadow_stats['winmxunlimited']['positives'])
+        self.assertEqual(1, self.p.shadow_stats['winmxunlimited']['disagreements'])
+
+    def test_event_client_connect_traced(self):
+        # GIVEN
+        path = self.start_tracing()
+        self.mike.kick = Mock()
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        traces = self.read_traces(path)
+        self.assertEqual(1, len(traces))
+        self.assertEqual('flagged', traces[0]['outcome'])
+        self.assertEqual('127.0.0.1', traces[0]['ip'])
+        # the geolocation plugin is disabled: there's no geolocation wait to trace
+        self.assertListEqual(['queue', 'scan', 'verdict', 'store', 'kick', 'announce'],
+                             [x['name'] for x in traces[0]['spans']])
+        self.assertEqual('winmxunlimited', traces[0]['spans'][1]['service'])
+
+    def test_event_client_connect_traced_geolocation(self):
+        # GIVEN
+        path = self.start_tracing()
+        self.p.settings['services']['geolocationplugin']['enabled'] = True
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(False)
+        self.mike.connects("1")
+        # WHEN
+        self.console.queueEvent(self.console.getEvent('EVT_CLIENT_GEOLOCATION_SUCCESS', client=self.mike))
+        sleep(.5)
+        # THEN
+        traces = self.read_traces(path)
+        self.assertEqual(1, len(traces))
+        self.assertListEqual(['geolocation', 'queue', 'scan', 'verdict'], [x['name'] for x in traces[0]['spans']])
+
+    def test_event_client_connect_not_sampled(self):
+        # GIVEN
+        path = self.start_tracing()
+        self.p.tracer.start = Mock(return_value=None)
+        self.mike.kick = Mock()
+        # WHEN
+        when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
+        self.mike.connects("1")
+        sleep(.5)
+        # THEN
+        self.assertEqual(1, self.p.tracer.start.call_count)
+        self.assertEqual(0, os.path.getsize(path))
+        self.assertDictEqual({}, self.p._traces)
+
     ####################################################################################################################
     ##                                                                                                                ##
     ##  TEST PLUGIN ENABLE                                                                                            ##
@@ -116,7 +392,7 @@ class Test_events(ProxyfilterTestCase):
     #    self.p.disable()
     #    self.mike.kick = Mock()
     #    # WHEN
-    #    when(self.p.services['winmxunlimited']).scan(self.mike).thenReturn(True)
+    #    when(self.p.services['winmxunlimited']).scan(anything()).thenReturn(True)
     #    self.mike.connects("1")
     #    self.p.enable()
     #    # THEN
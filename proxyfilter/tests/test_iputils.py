@@ -0,0 +1,121 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import unittest2
+
+from b3.config import CfgConfigParser
+from . import ProxyfilterTestCase
+from proxyfilter import ProxyfilterPlugin
+from proxyfilter.iputils import bytes2long
+from proxyfilter.iputils import format_network
+from proxyfilter.iputils import ip2long
+from proxyfilter.iputils import is_ipv4
+from proxyfilter.iputils import long2bytes
+from proxyfilter.iputils import long2ip
+from proxyfilter.iputils import parse_network
+from proxyfilter.iputils import prefix_network
+from proxyfilter.iputils import split_families
+
+
+class Test_iputils(unittest2.TestCase):
+
+    def test_ipv4(self):
+        self.assertEqual(0xffff7f000001, ip2long('127.0.0.1'))
+        self.assertEqual(0xffff00000000, ip2long('0.0.0.0'))
+        self.assertEqual(0xffffffffffff, ip2long(' 255.255.255.255 '))
+        self.assertTrue(is_ipv4(ip2long('10.0.0.1')))
+        for ip in ('127.0.0.1', '0.0.0.0', '255.255.255.255', '203.0.113.42'):
+            self.assertEqual(ip, long2ip(ip2long(ip)))
+
+    def test_ipv4_mapped(self):
+        self.assertEqual(ip2long('1.2.3.4'), ip2long('::ffff:1.2.3.4'))
+        self.assertEqual(ip2long('1.2.3.4'), ip2long('::FFFF:102:304'))
+        self.assertEqual('1.2.3.4', long2ip(ip2long('::ffff:1.2.3.4')))
+        self.assertFalse(is_ipv4(ip2long('::1.2.3.4')))
+
+    def test_ipv6(self):
+        self.assertEqual(0, ip2long('::'))
+        self.assertEqual(1, ip2long('::1'))
+        self.assertEqual(0x20010db8000000000000000000000001, ip2long('2001:db8::1'))
+        self.assertEqual(ip2long('2001:db8::1'), ip2long('2001:DB8:0:0:0:0:0:1'))
+        self.assertEqual(ip2long('2001:db8::1'), ip2long('[2001:db8::1]'))
+        self.assertEqual(ip2long('fe80::1'), ip2long('fe80::1%eth0'))
+        self.assertFalse(is_ipv4(ip2long('2001:db8::1')))
+
+    def test_long2ip_zero_compression(self):
+        self.assertEqual('::', long2ip(0))
+        self.assertEqual('::1', long2ip(1))
+        self.assertEqual('1::', long2ip(ip2long('1::')))
+        self.assertEqual('2001:db8::1', long2ip(ip2long('2001:0db8:0000:0000:0000:0000:0000:0001')))
+        # the longest run of zero groups is compressed, the first one on ties, never a single group
+        self.assertEqual('2001:0:0:1::1', long2ip(ip2long('2001:0:0:1:0:0:0:1')))
+        self.assertEqual('2001:db8::1:0:0:1', long2ip(ip2long('2001:db8:0:0:1:0:0:1')))
+        self.assertEqual('2001:db8:0:1:1:1:1:1', long2ip(ip2long('2001:db8:0:1:1:1:1:1')))
+        self.assertEqual('1:2:3:4:5:6:7:8', long2ip(ip2long('1:2:3:4:5:6:7:8')))
+
+    def test_invalid(self):
+        for ip in ('', '1.2.3', '1.2.3.4.5', '256.0.0.1', '1.2.3.-4', 'a.b.c.d', '1:::2', '1::2::3', '::12345',
+                   '1:2:3:4:5:6:7', '1:2:3:4:5:6:7:8:9', '1:2:3:4::5:6:7:8', '::0x1:1', '1::-1', '1::+1', '1:: 1',
+                   '::g', '::1.2.3', '::1.2.3.4:1'):
+            self.assertRaises(ValueError, ip2long, ip)
+
+    def test_bytes(self):
+        for ip in ('::', '::1', '10.0.0.1', '2001:db8::1', 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff'):
+            n = ip2long(ip)
+            self.assertEqual(16, len(long2bytes(n)))
+            self.assertEqual(n, bytes2long(long2bytes(n)))
+        self.assertEqual('00000000000000000000ffff0a000001', long2bytes(ip2long('10.0.0.1')).encode('hex'))
+        # the binary representation sorts like the integers
+        self.assertLess(long2bytes(ip2long('10.0.0.1')), long2bytes(ip2long('2001:db8::1')))
+
+    def test_networks(self):
+        self.assertTupleEqual((ip2long('10.0.0.0'), ip2long('10.0.0.255')), parse_network('10.0.0.42/24'))
+        self.assertTupleEqual((ip2long('10.0.0.1'), ip2long('10.0.0.1')), parse_network('10.0.0.1'))
+        self.assertTupleEqual((ip2long('2001:db8::'), ip2long('2001:db8:ffff:ffff:ffff:ffff:ffff:ffff')),
+                              parse_network('2001:db8::/32'))
+        self.assertTupleEqual((0, (1 << 128) - 1), parse_network('::/0'))
+        self.assertEqual('10.0.0.0/24', format_network(*parse_network('10.0.0.42/24')))
+        self.assertEqual('2001:db8::/32', format_network(*parse_network('2001:DB8:0::1/32')))
+        self.assertEqual('2001:db8:1::/48', format_network(*prefix_network(ip2long('2001:db8:1:2::1'))))
+        self.assertEqual('10.0.0.0/24', format_network(*prefix_network(ip2long('10.0.0.42'))))
+        for network in ('10.0.0.0/33', '2001:db8::/129', '10.0.0.0/-1', '10.0.0.0/', '10.0.0.0/x'):
+            self.assertRaises(ValueError, parse_network, network)
+
+    def test_split_families(self):
+        self.assertListEqual([(ip2long('10.0.0.0'), ip2long('10.0.0.255'), True)],
+                             split_families(*parse_network('10.0.0.0/24')))
+        self.assertListEqual([(ip2long('2001:db8::'), ip2long('2001:db8:ffff:ffff:ffff:ffff:ffff:ffff'), False)],
+                             split_families(*parse_network('2001:db8::/32')))
+        self.assertListEqual([(0, ip2long('::fffe:ffff:ffff'), False),
+                              (ip2long('0.0.0.0'), ip2long('255.255.255.255'), True),
+                              (ip2long('::1:0:0:0'), (1 << 128) - 1, False)], split_families(*parse_network('::/0')))
+
+
+class Test_sql_ip(ProxyfilterTestCase):
+
+    def setUp(self):
+        ProxyfilterTestCase.setUp(self)
+        self.p = ProxyfilterPlugin(self.console, CfgConfigParser())
+
+    def test_sql_ip(self):
+        self.assertEqual("X'00000000000000000000ffff0a000001'", self.p.sql_ip('10.0.0.1'))
+        self.assertEqual("X'20010db8000000000000000000000001'", self.p.sql_ip('2001:db8::1'))
+        self.assertEqual("X'20010db8000000000000000000000001'", self.p.sql_ip(ip2long('2001:DB8::1')))
+        self.assertEqual('NULL', self.p.sql_ip('not an ip'))
+        self.console.storage.dsnDict['protocol'] = 'postgresql'
+        self.assertEqual("DECODE('20010db8000000000000000000000001', 'hex')", self.p.sql_ip('2001:db8::1'))
@@ -0,0 +1,103 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import sys
+import tempfile
+import unittest2
+
+from mock import patch
+from textwrap import dedent
+from threading import enumerate as threads
+from . import logging_disabled
+from .replay import DEFAULT_CONFIG
+from .replay import LogEvent
+from .replay import parse_ip
+from .replay import parse_log
+from .replay import replay
+
+
+class Test_replay(unittest2.TestCase):
+
+    def write_log(self, data):
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            f.write(dedent(data).lstrip())
+        return path
+
+    def test_parse_ip(self):
+        self.assertEqual('1.2.3.4', parse_ip('1.2.3.4:27960'))
+        self.assertEqual('1.2.3.4', parse_ip('1.2.3.4'))
+        self.assertEqual('2001:db8::1', parse_ip('[2001:db8::1]:27960'))
+        self.assertEqual('2001:db8::1', parse_ip('2001:db8::1'))
+
+    def test_parse_game_log(self):
+        # GIVEN
+        path = self.write_log(r"""
+              0:00 InitGame: \sv_hostname\test
+              0:05 ClientConnect: 0
+              0:05 ClientUserinfo: 0 \ip\1.2.3.4:27960\name\^1Mike\cl_guid\ABCDEF0123456789
+              0:07 ClientUserinfo: 1 \ip\bot\name\Bot
+              1:10 ClientUserinfo: 2 \ip\[2001:db8::1]:27960\name\Bill
+              1:30 ClientDisconnect: 0
+              0:00 InitGame: \sv_hostname\test
+              0:20 ClientUserinfo: 0 \ip\1.2.3.4:27960\name\Mike\cl_guid\ABCDEF0123456789
+        """)
+        # WHEN
+        events = parse_log(path)
+        # THEN
+        self.assertListEqual([LogEvent(5, 'connect', '0', '1.2.3.4', 'Mike', 'ABCDEF0123456789'),
+                              LogEvent(70, 'connect', '2', '2001:db8::1', 'Bill', events[1].guid),
+                              LogEvent(90, 'disconnect', '0', None, None, None),
+                              # the server restarted: timestamps never go backwards
+                              LogEvent(90, 'connect', '0', '1.2.3.4', 'Mike', 'ABCDEF0123456789')], events)
+        # clients with no guid get a stable one
+        self.assertEqual(32, len(events[1].guid))
+
+    def test_parse_b3_log(self):
+        # GIVEN
+        path = self.write_log(r"""
+            151019 21:04:33	VERBOSE	ClientUserinfo: 3 \ip\5.6.7.8:27960\name\Foo\cl_guid\0123
+            151019 21:04:30	VERBOSE	ClientUserinfo: 4 \ip\localhost\name\Local
+            151019 21:05:00	VERBOSE	ClientDisconnect: 3
+            151019 21:05:01	DEBUG	Client disconnected: 3
+        """)
+        # WHEN
+        events = parse_log(path)
+        # THEN
+        self.assertListEqual([(1445288673, 'connect', '3', '5.6.7.8'), (1445288700, 'disconnect', '3', None)],
+                             [x[:4] for x in events])
+
+    def test_replay(self):
+        # GIVEN
+        events = [LogEvent(0, 'connect', '0', '1.2.3.4', 'Mike', 'GUID0'),
+                  LogEvent(1, 'connect', '1', '5.6.7.8', 'Bill', 'GUID1'),
+                  LogEvent(2, 'disconnect', '1', None, None, None)]
+        running = set(threads())
+        # WHEN
+        with logging_disabled(), patch.object(sys, 'stdout'):
+            stats = replay(events, DEFAULT_CONFIG, ['winmxunlimited:0:1:remote'], drain=5)
+        # THEN
+        self.assertEqual(2, stats['connections'])
+        self.assertEqual(2, len(stats['kicks']))
+        self.assertListEqual([('winmxunlimited', True, False, 2)], stats['scanners'])
+        self.assertEqual(0, stats['pending'])
+        # the plugin has been stopped
+        self.assertListEqual([], [x for x in threads() if x not in running and x.getName().startswith('proxyfilter-')])
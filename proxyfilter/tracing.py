@@ -0,0 +1,148 @@
+#
+# ProxyFilter Plugin for BigBrotherBot(B3) (www.bigbrotherbot.net)
+# Copyright (C) 2014 Daniele Pantaleone <fenix@bigbrotherbot.net>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+
+import cProfile
+import json
+import logging
+import pstats
+
+from itertools import count
+from logging.handlers import RotatingFileHandler
+from random import random
+from threading import currentThread
+from threading import Lock
+from time import time
+
+
+class Trace(object):
+    """
+    The timeline of a single proxy scan, from the client connection to the verdict enforcement.
+    Span offsets and durations are expressed in milliseconds since the start of the trace.
+    """
+    __slots__ = ('id', 'start', 'spans', 'attrs')
+
+    def __init__(self, id, start=None):
+        """
+        Object constructor.
+        :param id: The trace identifier
+        :param start: The timestamp the trace starts at (default: now)
+        """
+        self.id = id
+        self.start = time() if start is None else start
+        self.spans = []
+        self.attrs = {}
+
+    def span(self, name, start, end=None, **attrs):
+        """
+        Record a span of the trace (an instantaneous one if no end timestamp is given).
+        """
+        span = {'name': name,
+                'start': round((start - self.start) * 1000, 3),
+                'duration': round(((start if end is None else end) - start) * 1000, 3)}
+        span.update(attrs)
+        self.spans.append(span)
+
+    def to_dict(self, end=None):
+        """
+        Return the JSON serializable representation of the trace.
+        """
+        data = dict(self.attrs)
+        data.update({'id': self.id,
+                     'time': round(self.start, 3),
+                     'total': round(((time() if end is None else end) - self.start) * 1000, 3),
+                     'spans': self.spans})
+        return data
+
+
+class Tracer(object):
+    """
+    Create sampled proxy scan traces and write them to a rotating JSON lines file.
+    Optionally profile the scan workers: the collected statistics are written next to the trace file.
+    """
+    def __init__(self, path, samplerate=1.0, maxbytes=10485760, backups=5, profile=False):
+        """
+        Object constructor.
+        :param path: The path of the trace file
+        :param samplerate: The fraction (0 to 1) of proxy scans being traced
+        :param maxbytes: The size of the trace file after which it's rotated
+        :param backups: The number of rotated trace files to keep
+        :param profile: Whether to profile the scan workers
+        """
+        self.path = path
+        self.samplerate = samplerate
+        self.profile = profile
+        self._ids = count(1)
+        self._handler = RotatingFileHandler(path, maxBytes=maxbytes, backupCount=backups)
+        self._handler.setFormatter(logging.Formatter('%(message)s'))
+        self._profiles = {}
+        self._profiles_lock = Lock()
+
+    def start(self, start=None):
+        """
+        Return a new Trace or None if the proxy scan is not sampled.
+        """
+        if self.samplerate < 1 and random() >= self.samplerate:
+            return None
+        return Trace(next(self._ids), start)
+
+    def finish(self, trace, **attrs):
+        """
+        Write the given trace to the trace file.
+        """
+        trace.attrs.update(attrs)
+        self._handler.handle(logging.makeLogRecord({'msg': json.dumps(trace.to_dict(), sort_keys=True),
+                                                    'levelno': logging.INFO,
+                                                    'levelname': 'INFO'}))
+
+    def run(self, func, *args, **kwargs):
+        """
+        Execute the given function: within the profiler of the calling thread if profiling is enabled.
+        """
+        if not self.profile:
+            return func(*args, **kwargs)
+
+        name = currentThread().getName()
+        with self._profiles_lock:
+            profiler = self._profiles.get(name)
+            if profiler is None:
+                profiler = self._profiles[name] = cProfile.Profile()
+        return profiler.runcall(func, *args, **kwargs)
+
+    def dump(self):
+        """
+        Write the statistics collected by the profilers of all the threads into <path>.prof.
+        :return: The path of the statistics file or None if nothing has been profiled
+        """
+        with self._profiles_lock:
+            profilers = self._profiles.values()
+        if not profilers:
+            return None
+
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        path = '%s.prof' % self.path
+        stats.dump_stats(path)
+        return path
+
+    def close(self):
+        """
+        Dump the profiling statistics (if any) and close the trace file.
+        """
+        self.dump()
+        self._handler.close()